@@ -1,30 +1,46 @@
 import os
 from flask import Flask
 from flask.json import JSONEncoder
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_openid import OpenID
-from flask_mail import Mail
 from flask_babel import Babel, lazy_gettext
-from config import basedir, ADMINS, MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD
+from config import basedir
+from .database import Database
+from .lazy import LazyExtension
 from .momentjs import momentjs
+from .presence import PresenceTracker
+from .resolver import UserResolver
+from .search import SearchIndex
+from .typeahead import NicknameIndex
+from .mailer import MailDispatcher
+from .fragments import FragmentCache
+from .graph import FollowGraph
+from .assets import AssetPipeline
+from .responses import Compressor
 
-app = Flask(__name__)
-app.config.from_object('config')
-db = SQLAlchemy(app)
+# the extensions are bound to an application by create_app(); OpenID and
+# Mail are only imported once something uses them
+db = Database()
 
 lm = LoginManager()
-lm.init_app(app)
-lm.login_view = 'login'
+lm.login_view = 'main.login'
 
 # def _gettext(msg):
 # 	return gettext(msg)
 # lm.localize_callback = gettext
 
 lm.login_message = lazy_gettext('Please log in to access this page.')
-oid = OpenID(app, os.path.join(basedir, 'tmp'))
-mail = Mail(app)
-babel = Babel(app)
+oid = LazyExtension('flask_openid', 'OpenID', fs_store_path=os.path.join(basedir, 'tmp'))
+mail = LazyExtension('flask_mail', 'Mail')
+mailer = MailDispatcher(mail=mail)
+babel = Babel()
+presence = PresenceTracker()
+users = UserResolver()
+search_index = SearchIndex()
+nickname_index = NicknameIndex()
+fragments = FragmentCache()
+graph = FollowGraph()
+assets = AssetPipeline()
+compressor = Compressor()
 
 class CustomJSONEncoder(JSONEncoder):
 	"""This class adds support for lazy translation texts to Flask's
@@ -41,29 +57,72 @@ class CustomJSONEncoder(JSONEncoder):
 
 		return super(CustomJSONEncoder, self).default(obj)
 
-app.json_encoder = CustomJSONEncoder
+def create_app(config=None):
+	"""Builds the application. Importing the package has no side effects;
+	run.py, wsgi.py, the scripts and the tests each call this once. The
+	settings come from config.py, updated from config: a dict, or an
+	object or import path for from_object()."""
+	app = Flask(__name__)
+	app.config.from_object('config')
+	if isinstance(config, dict):
+		app.config.update(config)
+	elif config is not None:
+		app.config.from_object(config)
+	app.json_encoder = CustomJSONEncoder
 
-if not app.debug:
-	import logging
-	from logging.handlers import SMTPHandler
-	credentials = None
-	if MAIL_USERNAME or MAIL_PASSWORD:
-		credentials = (MAIL_USERNAME, MAIL_PASSWORD)
-	mail_handler = SMTPHandler((MAIL_SERVER, MAIL_PORT), 'no-reply@' + MAIL_SERVER, ADMINS, 'microblog failure', credentials)
-	mail_handler.setLevel(logging.ERROR)
-	app.logger.addHandler(mail_handler)
+	db.init_app(app)
+	lm.init_app(app)
+	oid.init_app(app)
+	mail.init_app(app)
+	mailer.init_app(app, mail)
+	babel.init_app(app)
+	presence.init_app(app)
+	users.init_app(app)
+	search_index.init_app(app)
+	nickname_index.init_app(app)
+	fragments.init_app(app)
+	graph.init_app(app)
+	assets.init_app(app)
+	compressor.init_app(app)
+	app.jinja_env.globals['momentjs'] = momentjs
 
-if not app.debug:
-	import logging
-	from logging.handlers import RotatingFileHandler
-	file_handler = RotatingFileHandler('microblog/tmp/microblog.log', 'a', 1 * 1024 * 1024, 10)
-	file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-	app.logger.setLevel(logging.INFO)
-	file_handler.setLevel(logging.INFO)
-	app.logger.addHandler(file_handler)
-	app.logger.info('microblog startup')
+	@app.teardown_request
+	def remove_session(exception=None):
+		# one session per request, also when the request runs inside an
+		# application context that outlives it, as in scripts and tests
+		db.session.remove()
+
+	from .views import main
+	app.register_blueprint(main)
 
-app.jinja_env.globals['momentjs'] = momentjs
+	if not app.debug and not app.testing:
+		setup_logging(app)
+
+	return app
+
+def setup_logging(app):
+	"""Mails errors to the ADMINS and logs to LOG_FILE (None turns the file
+	log off)."""
+	import logging
+	from logging.handlers import SMTPHandler, RotatingFileHandler
+	config = app.config
+	if config.get('ADMINS') and config.get('MAIL_SERVER'):
+		credentials = None
+		if config.get('MAIL_USERNAME') or config.get('MAIL_PASSWORD'):
+			credentials = (config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+		mail_handler = SMTPHandler((config['MAIL_SERVER'], config['MAIL_PORT']), 'no-reply@' + config['MAIL_SERVER'], config['ADMINS'], 'microblog failure', credentials)
+		mail_handler.setLevel(logging.ERROR)
+		app.logger.addHandler(mail_handler)
 
-from app import views, models
+	if config.get('LOG_FILE'):
+		directory = os.path.dirname(config['LOG_FILE'])
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		file_handler = RotatingFileHandler(config['LOG_FILE'], 'a', 1 * 1024 * 1024, 10)
+		file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+		app.logger.setLevel(logging.INFO)
+		file_handler.setLevel(logging.INFO)
+		app.logger.addHandler(file_handler)
+		app.logger.info('microblog startup')
 
+from app import models
@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import threading
+from flask import abort, request, url_for
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# bundled files point at source maps that are not served next to the bundle
+SOURCE_MAP = re.compile(br'^//# sourceMappingURL=.*$', re.M)
+
+# formats worth compressing, the images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.eot', '.ttf')
+
+# the moment.js build each MOMENTJS_MODE needs
+MOMENTJS_SCRIPTS = {'client': 'js/moment.min.js', 'server': 'js/moment-lite.js'}
+
+class AssetPipeline(object):
+	"""Serves app/static under content fingerprinted names. On first use
+	every static file, and every bundle in ASSET_BUNDLES, is hashed into a
+	manifest; templates call static_url('css/x.css') to get
+	/assets/css/x.<hash>.css. Those URLs never change content, so they are
+	served with ASSETS_MAX_AGE immutable caching, in gzip or (with the
+	brotli package) br encoding when the client accepts it. Compressed
+	variants are built on first request and kept in memory.
+	ASSETS_ENABLED = False falls back to plain /static URLs."""
+	def __init__(self, app=None):
+		self.app = None
+		self.manifest = None	# static file or bundle name -> fingerprinted name
+		self.sources = {}	# fingerprinted name -> the static files it is made of
+		self.variants = {}	# (fingerprinted name, encoding) -> bytes
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		self.enabled = app.config.get('ASSETS_ENABLED', True)
+		self.max_age = app.config.get('ASSETS_MAX_AGE', 31536000)
+		app.jinja_env.globals['static_url'] = self.static_url
+		app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+
+	def build(self):
+		root = self.app.static_folder
+		manifest, sources = {}, {}
+		for dirpath, dirnames, filenames in os.walk(root):
+			for filename in filenames:
+				name = os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+				fingerprinted = self.fingerprint(name, self.read([name]))
+				manifest[name] = fingerprinted
+				sources[fingerprinted] = [name]
+		for name, parts in self.bundles().items():
+			fingerprinted = self.fingerprint(name, self.read(parts))
+			manifest[name] = fingerprinted
+			sources[fingerprinted] = parts
+		with self.lock:
+			self.manifest, self.sources = manifest, sources
+			self.variants = {}
+
+	def bundles(self):
+		"""ASSET_BUNDLES, with the moment.js build for MOMENTJS_MODE added to
+		MOMENTJS_BUNDLE. The mode is read here rather than in config.py, so
+		that a mode given to create_app() gets the script its templates use."""
+		config = self.app.config
+		bundles = dict((name, list(parts)) for name, parts in config.get('ASSET_BUNDLES', {}).items())
+		if config.get('MOMENTJS_BUNDLE'):
+			bundles.setdefault(config['MOMENTJS_BUNDLE'], []).append(MOMENTJS_SCRIPTS[config.get('MOMENTJS_MODE', 'client')])
+		return bundles
+
+	def ensure_built(self):
+		if self.manifest is None:
+			self.build()
+
+	def fingerprint(self, name, data):
+		base, ext = os.path.splitext(name)
+		return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:12], ext)
+
+	def read(self, parts):
+		chunks = []
+		for name in parts:
+			with open(os.path.join(self.app.static_folder, name), 'rb') as f:
+				chunks.append(f.read())
+		if len(chunks) == 1:
+			return chunks[0]
+		# the newline and semicolon keep one script from running into the next
+		return b';\n'.join(SOURCE_MAP.sub(b'', chunk).rstrip() for chunk in chunks) + b'\n'
+
+	def static_url(self, filename):
+		if self.enabled:
+			self.ensure_built()
+		fingerprinted = self.manifest.get(filename) if self.enabled else None
+		if fingerprinted is None:
+			return url_for('static', filename=filename)
+		return url_for('assets', filename=fingerprinted)
+
+	def negotiate(self, filename):
+		if not filename.endswith(COMPRESSIBLE):
+			return None
+		for encoding in ('br', 'gzip'):
+			if (encoding != 'br' or brotli is not None) and request.accept_encodings[encoding]:
+				return encoding
+		return None
+
+	def variant(self, filename, encoding):
+		key = (filename, encoding)
+		data = self.variants.get(key)
+		if data is None:
+			data = self.read(self.sources[filename])
+			if encoding == 'gzip':
+				buf = io.BytesIO()
+				# mtime=0 makes every worker produce the same bytes
+				with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+					f.write(data)
+				data = buf.getvalue()
+			elif encoding == 'br':
+				data = brotli.compress(data)
+			with self.lock:
+				self.variants[key] = data
+		return data
+
+	def serve(self, filename):
+		self.ensure_built()
+		if filename not in self.sources:
+			abort(404)
+		encoding = self.negotiate(filename)
+		rv = self.app.response_class(self.variant(filename, encoding),
+									 mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+		if encoding is not None:
+			rv.headers['Content-Encoding'] = encoding
+		rv.headers['Vary'] = 'Accept-Encoding'
+		rv.headers['Cache-Control'] = 'public, max-age=%d, immutable' % self.max_age
+		rv.set_etag('%s-%s' % (filename, encoding or 'identity'))
+		return rv.make_conditional(request)
@@ -0,0 +1,47 @@
+import sqlite3
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+# ids bound into one IN (...) at most; SQLite allows 999 bound parameters
+# per statement
+BATCH = 500
+
+class Database(SQLAlchemy):
+	"""Flask-SQLAlchemy with the engine tuned from the config. Every SQLite
+	connection runs SQLITE_PRAGMAS as it is opened (WAL journal, so that
+	writes do not block readers, relaxed syncing, cache and mmap sizes and
+	a busy timeout), and a file database gets a real connection pool when
+	SQLALCHEMY_POOL_SIZE is set. The SQLALCHEMY_POOL_* settings apply to a
+	server database too, so moving to one only takes a new
+	SQLALCHEMY_DATABASE_URI."""
+	def __init__(self, *args, **kwargs):
+		self.pragmas = {}
+		super(Database, self).__init__(*args, **kwargs)
+		event.listen(Engine, 'connect', self.on_connect)
+
+	def init_app(self, app):
+		self.pragmas = app.config.get('SQLITE_PRAGMAS', {})
+		super(Database, self).init_app(app)
+
+	def apply_driver_hacks(self, app, info, options):
+		super(Database, self).apply_driver_hacks(app, info, options)
+		if info.drivername == 'sqlite' and options.get('pool_size') and 'poolclass' not in options:
+			# SQLAlchemy opens a new connection per checkout for SQLite
+			# files unless it is told to pool them; a pooled connection
+			# may be checked out by any thread, one at a time
+			options['poolclass'] = QueuePool
+			options.setdefault('connect_args', {})['check_same_thread'] = False
+		elif options.get('poolclass') is NullPool:
+			# SQLALCHEMY_POOL_SIZE = None turns pooling off, leaving nothing
+			# for the other pool settings to configure
+			for name in ('max_overflow', 'pool_timeout', 'pool_recycle'):
+				options.pop(name, None)
+
+	def on_connect(self, dbapi_connection, connection_record):
+		if isinstance(dbapi_connection, sqlite3.Connection):
+			cursor = dbapi_connection.cursor()
+			for name, value in self.pragmas.items():
+				cursor.execute('PRAGMA %s = %s' % (name, value))
+			cursor.close()
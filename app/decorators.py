@@ -1,7 +1,38 @@
-from threading import Thread
+import time
+from functools import wraps
+from hashlib import sha1
+from flask import current_app, request, session, make_response
 
-def async(f):
-	def wrapper(*args, **kwargs):
-		thr = Thread(target=f, args=args, kwargs=kwargs)
-		thr.start()
-	return wrapper
\ No newline at end of file
+def conditional(tag):
+	"""Conditional GET for a view. tag(*args, **kwargs) returns a cheap
+	summary of everything the page depends on (None to skip); its hash
+	becomes a weak ETag, and a client that already has it gets a 304
+	without the view running.
+	The session's CSRF token is part of the ETag, so a page whose forms
+	carry another session's token is never revalidated. Pending flashes
+	always get the full page. Cache-Control comes from PAGE_CACHE_CONTROL."""
+	def decorator(f):
+		@wraps(f)
+		def wrapper(*args, **kwargs):
+			if request.method != 'GET' or session.get('_flashes'):
+				return f(*args, **kwargs)
+			# the forms on the page embed CSRF tokens which expire, so a page
+			# is never revalidated for more than half their lifetime
+			summary = tag(*args, **kwargs)
+			if summary is None:
+				return f(*args, **kwargs)
+			limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 3600
+			parts = (summary, session.get('csrf_token'), int(time.time() // (limit / 2)))
+			etag = sha1(repr(parts).encode('utf-8')).hexdigest()
+			if request.if_none_match.contains_weak(etag):
+				rv = current_app.response_class(status=304)
+			else:
+				rv = make_response(f(*args, **kwargs))
+				if rv.status_code != 200:
+					return rv
+			rv.set_etag(etag, weak=True)
+			if current_app.config.get('PAGE_CACHE_CONTROL'):
+				rv.headers['Cache-Control'] = current_app.config['PAGE_CACHE_CONTROL']
+			return rv
+		return wrapper
+	return decorator
@@ -1,22 +1,22 @@
-from flask import render_template
-from flask_mail import Message
-from app import mail
-from .decorators import async
+from itertools import groupby
+from flask import current_app, render_template
+from sqlalchemy.orm import joinedload
+from app import db, mail, mailer
 from config import ADMINS
-from app import app
+from .models import FollowerNotification
 
-# decorator
-@async
-def send_async_email(app, msg):
-	with app.app_context():
-		mail.send(msg)
+def new_message(subject, **kwargs):
+	# flask_mail is imported (and the extension set up) on first use
+	mail.get()
+	from flask_mail import Message
+	return Message(subject, **kwargs)
 
 # helper function
 def send_email(subject, sender, recipients, text_body, html_body):
-	msg = Message(subject, sender=sender, recipients=recipients)
+	msg = new_message(subject, sender=sender, recipients=recipients)
 	msg.body =  text_body
 	msg.html = html_body
-	send_async_email(app, msg)
+	mailer.send(msg)
 
 def follower_notification(followed, follower):
 	"""Helper function that sends an email to notify user of a new follower"""
@@ -27,4 +27,30 @@ def follower_notification(followed, follower):
 				render_template('follower_email.txt',
 								user=followed, follower=follower),
 				render_template('follower_email.html',
-								user=followed, follower=follower))
\ No newline at end of file
+								user=followed, follower=follower))
+
+def send_digests():
+	"""Sends every user in digest mode one email listing the followers
+	queued since the previous digest, over a single SMTP connection. Needs a
+	request context for the links; see send_digests.py."""
+	text = current_app.jinja_env.get_template('follower_digest.txt')
+	html = current_app.jinja_env.get_template('follower_digest.html')
+	pending = FollowerNotification.query \
+		.options(joinedload(FollowerNotification.recipient), joinedload(FollowerNotification.follower)) \
+		.order_by(FollowerNotification.recipient_id, FollowerNotification.timestamp).all()
+	sent = 0
+	with mail.connect() as connection:
+		for recipient_id, notifications in groupby(pending, key=lambda n: n.recipient_id):
+			notifications = list(notifications)
+			user = notifications[0].recipient
+			followers = [n.follower for n in notifications]
+			msg = new_message('[microblog] %d new followers' % len(followers) if len(followers) > 1 else
+						  '[microblog] %s is now following you!' % followers[0].nickname,
+						  sender=ADMINS[0], recipients=[user.email])
+			msg.body = text.render(user=user, followers=followers)
+			msg.html = html.render(user=user, followers=followers)
+			connection.send(msg)
+			FollowerNotification.query.filter(FollowerNotification.id.in_([n.id for n in notifications])).delete(synchronize_session=False)
+			db.session.commit()
+			sent += 1
+	return sent
@@ -2,6 +2,7 @@ from flask_wtf import Form
 from wtforms import StringField, BooleanField, TextAreaField, SubmitField
 from wtforms.validators import DataRequired, Length
 from flask_babel import gettext
+from app import users
 from app.models import User
 
 class LoginForm(Form):
@@ -13,6 +14,7 @@ class EditForm(Form):
 	"""Allows users to edit their profile"""
 	nickname = StringField('nickname', validators=[DataRequired()])
 	about_me = TextAreaField('about_me', validators=[Length(min=0, max=140)])
+	notify_digest = BooleanField('notify_digest', default=False)
 
 	def __init__(self, original_nickname, *args, **kwargs):
 		Form.__init__(self, *args, **kwargs)
@@ -26,7 +28,7 @@ class EditForm(Form):
 		if self.nickname.data != User.make_valid_nickname(self.nickname.data):
 			self.nickname.errors.append(gettext('This nickname has invalid characters. Please use letters, numbers, dots and underscores only.'))
 			return False
-		user = User.query.filter_by(nickname=self.nickname.data).first()
+		user = users.by_nickname(self.nickname.data)
 		if user != None:
 			self.nickname.errors.append(gettext('This nickname is already in use. Please choose another one.'))
 			return False
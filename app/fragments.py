@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from flask import g, render_template
+from flask_sqlalchemy import models_committed
+from jinja2 import Markup
+from sqlalchemy import inspect
+from .momentjs import relative_label
+
+class FragmentCache(object):
+	"""Size bounded LRU cache of rendered post.html fragments, keyed by post
+	id, post version (its timestamp), the author's nickname and email hash,
+	locale and, when times are rendered server side, the post's relative
+	age. Templates call render_post(post) in place of including post.html.
+	Entries are dropped when the post is edited or deleted and when its
+	author is renamed; having the author in the key keeps renames made by
+	other processes from being served stale. FRAGMENT_CACHE_SIZE = 0 turns
+	the cache off."""
+	def __init__(self, app=None):
+		self.size = 0
+		self.fragments = OrderedDict()	# (post id, version, nickname, email hash, locale, age) -> (html, author id)
+		self.by_post = {}	# post id -> its cached keys
+		self.by_author = {}	# author id -> ids of the cached posts
+		self.stats = {'hits': 0, 'misses': 0}
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.size = app.config.get('FRAGMENT_CACHE_SIZE', 0)
+		app.jinja_env.globals['render_post'] = self.render_post
+		models_committed.connect(self.on_models_committed, sender=app)
+
+	def render_post(self, post):
+		# server rendered times are part of the key so they do not go stale;
+		# the author is loaded along with the post
+		author = post.author
+		key = (post.id, post.timestamp, author.nickname, author.email_hash,
+			   getattr(g, 'locale', None), relative_label(post.timestamp))
+		with self.lock:
+			entry = self.fragments.get(key)
+			if entry is not None:
+				self.fragments.move_to_end(key)
+				self.stats['hits'] += 1
+				return entry[0]
+			self.stats['misses'] += 1
+		html = Markup(render_template('post.html', post=post))
+		if self.size:
+			with self.lock:
+				self.fragments[key] = (html, post.user_id)
+				self.by_post.setdefault(post.id, set()).add(key)
+				self.by_author.setdefault(post.user_id, set()).add(post.id)
+				while len(self.fragments) > self.size:
+					self._forget(next(iter(self.fragments)))
+		return html
+
+	def _forget(self, key):
+		html, author_id = self.fragments.pop(key)
+		keys = self.by_post[key[0]]
+		keys.discard(key)
+		if not keys:
+			del self.by_post[key[0]]
+			post_ids = self.by_author[author_id]
+			post_ids.discard(key[0])
+			if not post_ids:
+				del self.by_author[author_id]
+
+	def invalidate_posts(self, post_ids):
+		with self.lock:
+			for post_id in post_ids:
+				for key in list(self.by_post.get(post_id, ())):
+					self._forget(key)
+
+	def invalidate_author(self, user_id):
+		with self.lock:
+			post_ids = list(self.by_author.get(user_id, ()))
+		self.invalidate_posts(post_ids)
+
+	def clear(self):
+		with self.lock:
+			self.fragments.clear()
+			self.by_post.clear()
+			self.by_author.clear()
+
+	def on_models_committed(self, sender, changes):
+		from .models import Post, User
+		posts = set()
+		for obj, operation in changes:
+			identity = inspect(obj).identity
+			if identity is None or operation == 'insert':
+				continue
+			if isinstance(obj, Post):
+				posts.add(identity[0])
+			elif isinstance(obj, User):
+				self.invalidate_author(identity[0])
+		if posts:
+			self.invalidate_posts(posts)
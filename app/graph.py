@@ -0,0 +1,135 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .database import BATCH
+
+FOLLOWED = 'followed'	# the users a user follows
+FOLLOWERS = 'followers'	# the users following a user
+
+def contains(ids, id):
+	i = bisect_left(ids, id)
+	return i < len(ids) and ids[i] == id
+
+def intersect(a, b):
+	"""The ids found in both of two sorted id arrays, in order."""
+	if len(a) > len(b):
+		a, b = b, a
+	return array('i', (id for id in a if contains(b, id)))
+
+class FollowGraph(object):
+	"""In-memory adjacency of the follow graph. For up to GRAPH_CACHE_SIZE
+	recently used users it keeps the ids of the users they follow and of
+	their followers as sorted int arrays, loaded with one query for a whole
+	batch of users and kept for GRAPH_CACHE_TTL seconds, after which the
+	changes made by other processes show up. follow() and unfollow() record
+	their edge on the session, and it is applied to the cached arrays when
+	the session commits. It is meant for what may lag by a minute, such as
+	"followed by" and suggestions; the viewer's own follow button asks the
+	database. GRAPH_CACHE_SIZE = 0 turns the cache off."""
+	def __init__(self, app=None):
+		self.size = 0
+		self.ttl = 0
+		self.adjacency = OrderedDict()	# (FOLLOWED or FOLLOWERS, user id) -> (sorted ids, expiry)
+		self.lock = threading.Lock()
+		event.listen(Session, 'after_commit', self.on_commit)
+		event.listen(Session, 'after_rollback', self.on_rollback)
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.size = app.config.get('GRAPH_CACHE_SIZE', 0)
+		self.ttl = app.config.get('GRAPH_CACHE_TTL', 0)
+
+	def followed_ids(self, user_id):
+		"""Sorted array of the ids of the users that user_id follows."""
+		return self.load(FOLLOWED, [user_id])[user_id]
+
+	def follower_ids(self, user_id):
+		"""Sorted array of the ids of the followers of user_id."""
+		return self.load(FOLLOWERS, [user_id])[user_id]
+
+	def is_following(self, follower_id, followed_id):
+		return contains(self.followed_ids(follower_id), followed_id)
+
+	def are_following(self, pairs):
+		"""is_following() for many (follower id, followed id) pairs, loading
+		every follower that is not cached in one query."""
+		pairs = list(pairs)
+		followed = self.load(FOLLOWED, set(follower_id for follower_id, followed_id in pairs))
+		return [contains(followed[follower_id], followed_id) for follower_id, followed_id in pairs]
+
+	def followed_by_followed(self, user_id, other_id):
+		"""Ids of the users followed by user_id who follow other_id, the
+		"followed by people you follow" of a profile page."""
+		return intersect(self.followed_ids(user_id), self.follower_ids(other_id))
+
+	def load(self, direction, user_ids):
+		adjacency, missing = {}, []
+		now = time.time()
+		with self.lock:
+			for user_id in user_ids:
+				entry = self.adjacency.get((direction, user_id))
+				if entry is not None and entry[1] >= now:
+					self.adjacency.move_to_end((direction, user_id))
+					adjacency[user_id] = entry[0]
+				else:
+					missing.append(user_id)
+		for i in range(0, len(missing), BATCH):
+			loaded = self.query(direction, missing[i:i + BATCH])
+			if self.size:
+				with self.lock:
+					for user_id, ids in loaded.items():
+						self.adjacency[(direction, user_id)] = (ids, now + self.ttl)
+						self.adjacency.move_to_end((direction, user_id))
+					while len(self.adjacency) > self.size:
+						self.adjacency.popitem(last=False)
+			adjacency.update(loaded)
+		return adjacency
+
+	def query(self, direction, user_ids):
+		from app import db
+		from .models import followers
+		if direction == FOLLOWED:
+			key, other = followers.c.follower_id, followers.c.followed_id
+		else:
+			key, other = followers.c.followed_id, followers.c.follower_id
+		adjacency = dict((user_id, array('i')) for user_id in user_ids)
+		# both orders are covered by an index, so this reads no table rows
+		for user_id, other_id in db.session.query(key, other).filter(key.in_(user_ids)).order_by(key, other):
+			adjacency[user_id].append(other_id)
+		return adjacency
+
+	def record(self, session, follower_id, followed_id, following):
+		"""Queues a follow (following=True) or unfollow made in session."""
+		session.info.setdefault('follow_graph', []).append((follower_id, followed_id, following))
+
+	def on_commit(self, session):
+		for follower_id, followed_id, following in session.info.pop('follow_graph', []):
+			self.update((FOLLOWED, follower_id), followed_id, following)
+			self.update((FOLLOWERS, followed_id), follower_id, following)
+
+	def on_rollback(self, session):
+		session.info.pop('follow_graph', None)
+
+	def update(self, key, id, add):
+		with self.lock:
+			entry = self.adjacency.get(key)
+			if entry is None:
+				return
+			# a new array, readers may still be going through the old one
+			ids = array('i', entry[0])
+			i = bisect_left(ids, id)
+			present = i < len(ids) and ids[i] == id
+			if add and not present:
+				ids.insert(i, id)
+			elif not add and present:
+				del ids[i]
+			self.adjacency[key] = (ids, entry[1])
+
+	def clear(self):
+		with self.lock:
+			self.adjacency.clear()
@@ -0,0 +1,51 @@
+import threading
+from importlib import import_module
+
+class LazyExtension(object):
+	"""Stands in for a Flask extension whose module is slow to import. The
+	module is imported, the extension built and init_app() called for
+	every application seen so far the first time one of its attributes is
+	used, so scripts and workers that never need it never pay for it.
+	on_load() callbacks run right after, with the real extension."""
+	def __init__(self, module, name, *args, **kwargs):
+		self.module = module
+		self.name = name
+		self.args = args
+		self.kwargs = kwargs
+		self.apps = []
+		self.callbacks = []
+		self.extension = None
+		self.lock = threading.RLock()
+
+	def init_app(self, app):
+		with self.lock:
+			self.apps.append(app)
+			if self.extension is not None:
+				self.extension.init_app(app)
+
+	def on_load(self, callback):
+		with self.lock:
+			if self.extension is not None:
+				callback(self.extension)
+			else:
+				self.callbacks.append(callback)
+		return callback
+
+	def get(self):
+		if self.extension is None:
+			with self.lock:
+				if self.extension is None:
+					extension = getattr(import_module(self.module), self.name)(*self.args, **self.kwargs)
+					for app in self.apps:
+						extension.init_app(app)
+					for callback in self.callbacks:
+						callback(extension)
+					self.extension = extension
+		return self.extension
+
+	@property
+	def loaded(self):
+		return self.extension is not None
+
+	def __getattr__(self, name):
+		return getattr(self.get(), name)
@@ -0,0 +1,128 @@
+import atexit
+import threading
+import time
+from queue import Queue, Empty, Full
+
+# queued in place of a message to tell a worker to stop
+STOP = object()
+
+class MailDispatcher(object):
+	"""Sends mail from a bounded queue with a fixed pool of MAIL_WORKERS
+	threads. Each worker keeps its SMTP connection open while there is mail
+	to send and closes it after MAIL_IDLE_TIMEOUT idle seconds. When the
+	queue is full, send() waits up to MAIL_QUEUE_TIMEOUT seconds and then
+	drops the message, counting it in stats['dropped']."""
+	def __init__(self, app=None, mail=None):
+		self.app = None
+		self.mail = mail
+		self.threads = []
+		self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0}
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app, mail)
+
+	def init_app(self, app, mail):
+		self.app = app
+		self.mail = mail
+		self.workers = app.config.get('MAIL_WORKERS', 2)
+		self.timeout = app.config.get('MAIL_QUEUE_TIMEOUT', 1)
+		self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 5)
+		self.queue = Queue(app.config.get('MAIL_QUEUE_SIZE', 1000))
+		atexit.register(self.shutdown)
+
+	def count(self, stat):
+		with self.lock:
+			self.stats[stat] += 1
+
+	def send(self, msg):
+		"""Queues a message for delivery. Returns False if it was dropped."""
+		self.start()
+		try:
+			if self.timeout:
+				self.queue.put(msg, timeout=self.timeout)
+			else:
+				self.queue.put_nowait(msg)
+		except Full:
+			self.count('dropped')
+			self.app.logger.warning('mail queue full, dropped message to %s', ', '.join(msg.recipients))
+			return False
+		self.count('queued')
+		return True
+
+	def start(self):
+		with self.lock:
+			if self.threads:
+				return
+			for i in range(self.workers):
+				thread = threading.Thread(target=self.run, name='mail-worker-%d' % i)
+				thread.daemon = True
+				self.threads.append(thread)
+		for thread in self.threads:
+			thread.start()
+
+	def run(self):
+		with self.app.app_context():
+			connection = None
+			while True:
+				try:
+					msg = self.queue.get(timeout=self.idle_timeout if connection else None)
+				except Empty:
+					connection = self.disconnect(connection)
+					continue
+				if msg is STOP:
+					self.queue.task_done()
+					break
+				try:
+					if connection is None:
+						connection = self.mail.connect().__enter__()
+					connection.send(msg)
+					self.count('sent')
+				except Exception:
+					self.count('failed')
+					self.app.logger.exception('could not send mail to %s', ', '.join(msg.recipients))
+					connection = self.disconnect(connection)
+				finally:
+					self.queue.task_done()
+			self.disconnect(connection)
+
+	def disconnect(self, connection):
+		if connection is not None:
+			try:
+				connection.__exit__(None, None, None)
+			except Exception:
+				pass
+		return None
+
+	def shutdown(self, timeout=10):
+		"""Lets the workers finish the queued mail, then stops them. If the
+		queue is still full after timeout seconds, as when the SMTP server
+		is down, the mail left in it is dropped so that exiting never
+		hangs."""
+		with self.lock:
+			threads, self.threads = self.threads, []
+		deadline = time.time() + timeout
+		stops = len(threads)
+		while stops:
+			try:
+				self.queue.put(STOP, timeout=max(deadline - time.time(), 0.001))
+				stops -= 1
+			except Full:
+				stops += self.drain()
+		for thread in threads:
+			thread.join(max(deadline - time.time(), 0))
+
+	def drain(self):
+		"""Empties the queue, dropping its mail, and returns how many STOPs
+		were taken out with it."""
+		stops = 0
+		while True:
+			try:
+				msg = self.queue.get_nowait()
+			except Empty:
+				return stops
+			self.queue.task_done()
+			if msg is STOP:
+				stops += 1
+			else:
+				self.count('dropped')
+				self.app.logger.warning('mail queue full at exit, dropped message to %s', ', '.join(msg.recipients))
@@ -1,31 +1,84 @@
 import re
-from app import db, app
+from flask import current_app
+from app import db, users, graph
 from hashlib import md5
+from functools import lru_cache
+from sqlalchemy import bindparam, select, literal, func, event
+from sqlalchemy.orm import joinedload, validates
+from .pagination import KeysetQuery
 
+# a user's followed list is looked up by follower_id, the audience of a new
+# post by followed_id, so there is an index leading with each
 followers = db.Table('followers',
 	db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-	db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+	db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+	db.Index('ix_followers_follower_followed', 'follower_id', 'followed_id', unique=True),
+	db.Index('ix_followers_followed_follower', 'followed_id', 'follower_id'))
 
-posthearts = db.Table('posthearts',
-	db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-	db.Column('post_id', db.Integer, db.ForeignKey('post.id')),
-	db.Column('timestamp', db.DateTime))
+# materialized home timeline, one row per (follower, post). Only maintained
+# when TIMELINE_ENABLED is set; see Post.fan_out() and User.rebuild_timeline()
+timeline = db.Table('timeline',
+	db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+	db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+	db.Column('timestamp', db.DateTime),
+	db.Index('ix_timeline_follower_timestamp', 'follower_id', 'timestamp'))
+
+@lru_cache(maxsize=4096)
+def avatar_url(email_hash, size):
+	return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (email_hash, size)
+
+def email_hash(email):
+	return md5(email.encode('utf-8')).hexdigest()
+
+def adjust_counter(obj, column, delta):
+	"""Adds delta to a denormalized counter column of obj with an UPDATE in
+	the current transaction, so concurrent requests cannot lose increments."""
+	if obj.id is None:
+		db.session.flush()
+	type(obj).query.filter_by(id=obj.id).update({column: column + delta}, synchronize_session=False)
+	db.session.expire(obj, [column.key])
+	if isinstance(obj, User):
+		users.invalidate(obj.id)
+
+def row_exists(query):
+	"""Whether query matches any row, asked as SELECT EXISTS (...) so the
+	database stops at the first match instead of counting them all."""
+	return db.session.query(query.exists()).scalar()
+
+def reconcile_counters():
+	"""Recomputes every denormalized counter from the rows it summarizes.
+	Run through db_reconcile.py if the counters ever drift."""
+	user = User.__table__
+	post = Post.__table__
+	hearts = UserPostHearts.__table__
+	db.session.execute(user.update().values(
+		follower_count=select([func.count()]).where(followers.c.followed_id == user.c.id).as_scalar(),
+		followed_count=select([func.count()]).where(followers.c.follower_id == user.c.id).as_scalar(),
+		post_count=select([func.count()]).where(post.c.user_id == user.c.id).as_scalar()))
+	db.session.execute(post.update().values(
+		heart_count=select([func.count()]).where(hearts.c.post_id == post.c.id).as_scalar()))
 
 class User(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	nickname = db.Column(db.String(64), index=True, unique=True)
 	email = db.Column(db.String(120), index=True, unique=True)
-	posts = db.relationship('Post', backref='author', lazy='dynamic')
+	email_hash = db.Column(db.String(32))
+	posts = db.relationship('Post', backref='author', lazy='dynamic', query_class=KeysetQuery)
 	about_me = db.Column(db.String(140))
 	last_seen = db.Column(db.DateTime)
+	follower_count = db.Column(db.Integer, default=0, nullable=False)
+	followed_count = db.Column(db.Integer, default=0, nullable=False)
+	post_count = db.Column(db.Integer, default=0, nullable=False)
+	notify_digest = db.Column(db.Boolean, default=False, nullable=False)
+	# set when the follows the suggestions were computed from change
+	suggestions_stale = db.Column(db.Boolean, default=True, nullable=False)
 	followed = db.relationship('User',
 								secondary=followers,
 								primaryjoin=(followers.c.follower_id == id),
 								secondaryjoin=(followers.c.followed_id == id),
 								backref=db.backref('followers', lazy='dynamic'),
 								lazy='dynamic')
-	post_hearts = db.relationship('UserPostHearts', backref=db.backref('user_hearts', lazy='joined'),
-								  lazy='dynamic', cascade='all, delete-orphan')
+	post_hearts = db.relationship('UserPostHearts', backref='user_hearts', lazy='dynamic', cascade='all, delete-orphan')
 
 	@property
 	def is_authenticated(self):
@@ -64,53 +117,268 @@ class User(db.Model):
 		except NameError:
 			return str(self.id) #python 3
 
+	@validates('email')
+	def validate_email(self, key, email):
+		self.email_hash = email_hash(email) if email is not None else None
+		return email
+
 	def avatar(self, size):
-		return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (md5(self.email.encode('utf-8')).hexdigest(), size)
+		return avatar_url(self.email_hash, size)
 
 	def follow(self, user):
 		if not self.is_following(user):
 			self.followed.append(user)
+			adjust_counter(self, User.followed_count, 1)
+			adjust_counter(user, User.follower_count, 1)
+			graph.record(db.session(), self.id, user.id, True)
+			self.mark_suggestions_stale()
 			return self
 
 	def unfollow(self, user):
 		if self.is_following(user):
 			self.followed.remove(user)
+			adjust_counter(self, User.followed_count, -1)
+			adjust_counter(user, User.follower_count, -1)
+			graph.record(db.session(), self.id, user.id, False)
+			self.mark_suggestions_stale()
 			return self
 
+	def mark_suggestions_stale(self):
+		"""Queues this user for the next db_suggestions.py run. The
+		suggestions of their followers depend on whom they follow too; the
+		run finds those in its scan of the follow graph, so a follow costs
+		one row update however many followers there are."""
+		user = User.__table__
+		db.session.execute(user.update()
+			.where(user.c.id == self.id)
+			.where(user.c.suggestions_stale == False)
+			.values(suggestions_stale=True))
+
 	def is_following(self, user):
-		return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+		return row_exists(db.session.query(followers.c.followed_id)
+			.filter(followers.c.follower_id == self.id)
+			.filter(followers.c.followed_id == user.id))
+
+	def following_ids(self, ids):
+		"""The subset of the given user ids that this user follows, in one
+		query however many there are."""
+		ids = list(ids)
+		if not ids:
+			return set()
+		return set(id for id, in db.session.query(followers.c.followed_id)
+			.filter(followers.c.follower_id == self.id)
+			.filter(followers.c.followed_id.in_(ids)))
 
 	def did_heart(self, post):
-		return self.post_hearts.filter(UserPostHearts.user_id == self.id).filter(UserPostHearts.post_id == post.id).count() > 0
+		return UserPostHearts.exists(post.id, self.id)
+
+	def followed_posts(self, authors=True):
+		"""The home timeline, newest first. authors=False leaves out loading
+		the authors, for queries that select columns of their own."""
+		if current_app.config['TIMELINE_ENABLED']:
+			query = Post.query.join(timeline, (timeline.c.post_id == Post.id)).filter(timeline.c.follower_id == self.id).order_by(timeline.c.timestamp.desc()).keyset_by(timeline.c.timestamp, timeline.c.post_id)
+		else:
+			query = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+		return Post.for_display(query) if authors else query
 
-	def followed_posts(self):
-		return Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+	def profile_posts(self, authors=True):
+		query = self.posts.order_by(Post.timestamp.desc())
+		return Post.for_display(query) if authors else query
+
+	def rebuild_timeline(self):
+		"""Refills the materialized timeline of this user with the newest
+		TIMELINE_DEPTH posts of the users he/she follows. Used after a
+		follow/unfollow and by db_timeline.py to backfill existing data."""
+		db.session.execute(timeline.delete().where(timeline.c.follower_id == self.id))
+		recent = select([literal(self.id), Post.id, Post.timestamp]) \
+			.select_from(Post.__table__.join(followers, (followers.c.followed_id == Post.user_id))) \
+			.where(followers.c.follower_id == self.id) \
+			.order_by(Post.timestamp.desc()) \
+			.limit(current_app.config['TIMELINE_DEPTH'])
+		db.session.execute(timeline.insert().from_select(['follower_id', 'post_id', 'timestamp'], recent))
 
 	def __repr__(self):
 		return '<User %r>' %(self.nickname)
 
 class Post(db.Model):
 	__searchable__ = ['body']
-
+	query_class = KeysetQuery
 
 	id = db.Column(db.Integer, primary_key=True)
 	body = db.Column(db.String(140))
 	timestamp = db.Column(db.DateTime)
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-	user_hearts = db.relationship('UserPostHearts', backref=db.backref('post_hearts', lazy='joined'),
-								   lazy='dynamic', cascade='all, delete-orphan')
+	heart_count = db.Column(db.Integer, default=0, nullable=False)
+	# profile pages list a user's posts newest first, paged on (timestamp, id)
+	__table_args__ = (db.Index('ix_post_user_timestamp', user_id, timestamp.desc(), id.desc()),)
+	user_hearts = db.relationship('UserPostHearts', backref='post_hearts', lazy='dynamic', cascade='all, delete-orphan')
+
+	@staticmethod
+	def for_display(query):
+		"""Every query whose posts are rendered with post.html goes through
+		here, so their authors come back in the same SELECT instead of one
+		lazy load per post."""
+		return query.options(joinedload(Post.author))
+
+	def fan_out(self):
+		"""Pushes this post onto the timeline of every follower of its author,
+		then trims those timelines back to TIMELINE_DEPTH entries."""
+		if self.id is None:
+			db.session.flush()
+		db.session.execute(timeline.insert().from_select(['follower_id', 'post_id', 'timestamp'],
+			select([followers.c.follower_id, literal(self.id), literal(self.timestamp)]).where(followers.c.followed_id == self.user_id)))
+		# each follower's cutoff is looked up once, walking their timeline
+		# index, and the older rows go in one range delete per follower;
+		# correlating the cutoff with every row to delete instead costs
+		# followers x depth^2
+		audience = select([followers.c.follower_id]).where(followers.c.followed_id == self.user_id).alias()
+		cutoff = select([timeline.c.timestamp]) \
+			.where(timeline.c.follower_id == audience.c.follower_id) \
+			.order_by(timeline.c.timestamp.desc()) \
+			.limit(1).offset(current_app.config['TIMELINE_DEPTH'] - 1) \
+			.as_scalar()
+		trim = [{'follower': follower_id, 'cutoff': timestamp}
+				for follower_id, timestamp in db.session.execute(select([audience.c.follower_id, cutoff]))
+				if timestamp is not None]
+		if trim:
+			db.session.execute(timeline.delete()
+				.where(timeline.c.follower_id == bindparam('follower'))
+				.where(timeline.c.timestamp < bindparam('cutoff')), trim)
+
+	def claim(self):
+		"""Takes the write lock on this post's row ahead of deleting it.
+		False when a concurrent delete got there first, in which case the
+		author's post count was already taken down and must not be again."""
+		return Post.query.filter_by(id=self.id).update({Post.heart_count: Post.heart_count}, synchronize_session=False) > 0
+
+	def remove_from_timelines(self):
+		db.session.execute(timeline.delete().where(timeline.c.post_id == self.id))
+
+	@staticmethod
+	def load_hearts(posts, user):
+		"""Attaches hearted (by the given user) to every post of a rendered
+		page, using one query for the whole page instead of one per post.
+		The totals are kept in the heart_count column."""
+		hearted = UserPostHearts.hearted_by(user.id, [post.id for post in posts])
+		for post in posts:
+			post.hearted = post.id in hearted
+		return posts
+
+	@staticmethod
+	def page_summary(query, before=None, after=None, per_page=20):
+		"""What a page of query shows through post.html and the hearts: the
+		ids and heart counts of its posts and their authors' nicknames and
+		email hashes, read without loading the posts. The tags of the
+		conditional pages are built from it."""
+		page = query.join(User, User.id == Post.user_id) \
+			.with_entities(Post.id, Post.heart_count, User.nickname, User.email_hash) \
+			.paginate_keyset(before, after, per_page, False)
+		return tuple(tuple(row) for row in page.items), page.has_prev, page.has_next
 
 	def with_heart(self):
-		return self.user_hearts.filter(UserPostHearts.post_id == self.id).count() > 0
+		return UserPostHearts.exists(self.id)
 
 	def __repr__(self):
 		return '<Post %r>' %(self.body)
 
-class UserPostHearts(db.Model):
+class FollowerNotification(db.Model):
+	"""Outbox of new followers waiting for the next digest email of users
+	who chose digest delivery. Rows are removed once the digest is sent."""
 	id = db.Column(db.Integer, primary_key=True)
+	recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+	follower_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 	timestamp = db.Column(db.DateTime)
-	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-	post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+	recipient = db.relationship('User', foreign_keys=[recipient_id])
+	follower = db.relationship('User', foreign_keys=[follower_id])
 
 	def __repr__(self):
-		return '<Timestamp %r>' %(self.timestamp)
\ No newline at end of file
+		return '<FollowerNotification %r>' %(self.timestamp)
+
+class Suggestion(db.Model):
+	"""Who to follow, written by db_suggestions.py: for each user, the
+	SUGGESTIONS_PER_USER users followed by most of the people they follow,
+	best first. score is how many of those people follow the suggestion."""
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+	score = db.Column(db.Integer, nullable=False)
+
+	@staticmethod
+	def for_user(user_id, limit):
+		"""The suggested users, best first, in one query along the primary
+		key."""
+		return User.query.join(Suggestion, Suggestion.suggested_id == User.id) \
+			.filter(Suggestion.user_id == user_id) \
+			.order_by(Suggestion.rank) \
+			.limit(limit).all()
+
+	@staticmethod
+	def ids_for_user(user_id, limit):
+		"""The ids for_user() would return, from the primary key alone."""
+		return tuple(id for id, in db.session.query(Suggestion.suggested_id)
+			.filter(Suggestion.user_id == user_id)
+			.order_by(Suggestion.rank)
+			.limit(limit))
+
+	def __repr__(self):
+		return '<Suggestion %r>' %(self.rank)
+
+class UserPostHearts(db.Model):
+	"""One row per heart, keyed by the post and the user who hearted it.
+	The hearts of a post are one range of the primary key, and the index
+	covers the hearts of a user, so neither lookup reads the table."""
+	post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	timestamp = db.Column(db.DateTime)
+	__table_args__ = (db.Index('ix_user_post_hearts_user_post', 'user_id', 'post_id'),)
+
+	@staticmethod
+	def exists(post_id, user_id=None):
+		"""Whether the post has a heart (from the given user)."""
+		query = db.session.query(UserPostHearts.post_id).filter(UserPostHearts.post_id == post_id)
+		if user_id is not None:
+			query = query.filter(UserPostHearts.user_id == user_id)
+		return row_exists(query)
+
+	@staticmethod
+	def hearted_by(user_id, post_ids):
+		"""The subset of the given post ids that the user hearted, in one
+		query however many there are."""
+		post_ids = list(post_ids)
+		if not post_ids:
+			return set()
+		return set(post_id for post_id, in db.session.query(UserPostHearts.post_id)
+			.filter(UserPostHearts.user_id == user_id)
+			.filter(UserPostHearts.post_id.in_(post_ids)))
+
+	@staticmethod
+	def remove(post_id, user_id):
+		"""Takes the user's heart off the post. The heart count drops by
+		the rows the delete matched, so a second unheart racing the first
+		finds nothing to delete and leaves the count alone."""
+		removed = UserPostHearts.query.filter_by(post_id=post_id, user_id=user_id).delete(synchronize_session=False)
+		if removed:
+			Post.query.filter_by(id=post_id).update({Post.heart_count: Post.heart_count - removed}, synchronize_session=False)
+		return removed
+
+	def __repr__(self):
+		return '<Timestamp %r>' %(self.timestamp)
+
+# post and heart counters follow the rows however they are created or deleted
+@event.listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, post):
+	connection.execute(User.__table__.update().where(User.__table__.c.id == post.user_id).values(post_count=User.__table__.c.post_count + 1))
+	users.invalidate(post.user_id)
+
+@event.listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, post):
+	connection.execute(User.__table__.update().where(User.__table__.c.id == post.user_id).values(post_count=User.__table__.c.post_count - 1))
+	users.invalidate(post.user_id)
+
+@event.listens_for(UserPostHearts, 'after_insert')
+def heart_inserted(mapper, connection, heart):
+	connection.execute(Post.__table__.update().where(Post.__table__.c.id == heart.post_id).values(heart_count=Post.__table__.c.heart_count + 1))
+
+@event.listens_for(UserPostHearts, 'after_delete')
+def heart_deleted(mapper, connection, heart):
+	connection.execute(Post.__table__.update().where(Post.__table__.c.id == heart.post_id).values(heart_count=Post.__table__.c.heart_count - 1))
\ No newline at end of file
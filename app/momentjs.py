@@ -1,17 +1,90 @@
+from datetime import datetime
+from functools import lru_cache
+from babel import Locale
+from babel.dates import format_date, format_datetime, format_time, format_timedelta
+from flask import current_app, g
 from jinja2 import Markup
 
+# moment.js localized formats and the Babel format closest to each
+FORMATS = {
+    'LT': (format_time, 'short'),
+    'L': (format_date, 'short'),
+    'LL': (format_date, 'long'),
+    'LLL': (format_datetime, 'long'),
+    'LLLL': (format_datetime, 'full'),
+}
+
+class LocaleFormatter(object):
+    """Formats timestamps for one locale. The patterns are looked up once,
+    formatter() keeps one instance per locale."""
+    def __init__(self, locale):
+        self.locale = Locale.parse(locale)
+        self.time = self.locale.time_formats['short'].pattern
+        self.date = self.locale.date_formats['medium'].pattern
+        self.datetime = self.locale.datetime_formats['short']
+
+    def from_now(self, timestamp, now):
+        # minute granularity, so the text (and cached fragments) change at
+        # most once a minute
+        return format_timedelta(timestamp - now, granularity='minute', add_direction=True, locale=self.locale)
+
+    def calendar(self, timestamp, now):
+        """The time for today, weekday and time for the last week and the
+        date for anything older."""
+        days = (now.date() - timestamp.date()).days
+        if days == 0:
+            return format_time(timestamp, self.time, locale=self.locale)
+        if 0 < days < 7:
+            return self.datetime.format(format_time(timestamp, self.time, locale=self.locale),
+                                        format_date(timestamp, 'EEEE', locale=self.locale))
+        return format_date(timestamp, self.date, locale=self.locale)
+
+    def format(self, timestamp, fmt):
+        function, width = FORMATS.get(fmt, (format_datetime, 'medium'))
+        return function(timestamp, width, locale=self.locale)
+
+@lru_cache(maxsize=None)
+def formatter(locale):
+    return LocaleFormatter(locale)
+
+def server_side():
+    return current_app.config.get('MOMENTJS_MODE', 'client') == 'server'
+
+def relative_label(timestamp):
+    """The text fromNow() renders server side for a timestamp, None when
+    the times are rendered by moment.js in the browser."""
+    if not server_side():
+        return None
+    return formatter(getattr(g, 'locale', None) or 'en').from_now(timestamp, datetime.utcnow())
+
 class momentjs(object):
+    """Renders a UTC timestamp in templates. With MOMENTJS_MODE = 'client'
+    every call writes an inline moment.js script; with 'server' the text is
+    formatted here through Babel in the request locale and wrapped in a
+    <time> tag that static/js/moment-lite.js keeps fresh in the browser."""
     def __init__(self, timestamp):
         self.timestamp = timestamp
 
     def render(self, format):
         return Markup("<script>\ndocument.write(moment(\"%s\").%s);\n</script>" % (self.timestamp.strftime("%Y-%m-%dT%H:%M:%S Z"), format))
 
+    def render_tag(self, cls, text):
+        return Markup('<time class="%s" datetime="%s">%s</time>') % (cls, self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"), text)
+
+    def formatter(self):
+        return formatter(getattr(g, 'locale', None) or 'en')
+
     def format(self, fmt):
+        if server_side():
+            return self.render_tag('moment-format', self.formatter().format(self.timestamp, fmt))
         return self.render("format(\"%s\")" % fmt)
 
     def calendar(self):
+        if server_side():
+            return self.render_tag('moment-calendar', self.formatter().calendar(self.timestamp, datetime.utcnow()))
         return self.render("calendar()")
 
     def fromNow(self):
-        return self.render("fromNow()")
\ No newline at end of file
+        if server_side():
+            return self.render_tag('moment-from-now', self.formatter().from_now(self.timestamp, datetime.utcnow()))
+        return self.render("fromNow()")
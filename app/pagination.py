@@ -0,0 +1,83 @@
+from datetime import datetime
+from flask import abort
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_cursor(timestamp, id):
+	"""Turns the sort key of a row into an opaque string for the URL."""
+	return '%s-%d' % (timestamp.strftime(CURSOR_FORMAT), id)
+
+def decode_cursor(cursor):
+	"""Inverse of encode_cursor(). Raises ValueError on malformed input."""
+	timestamp, id = cursor.split('-')
+	return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+
+class KeysetPagination(object):
+	"""A page of results that knows its neighbours through cursors instead of
+	page numbers. Exposes the same items/has_prev/has_next surface as
+	Flask-SQLAlchemy's Pagination, with prev_cursor/next_cursor taking the
+	place of prev_num/next_num."""
+	def __init__(self, items, has_prev, has_next):
+		self.items = items
+		self.has_prev = has_prev
+		self.has_next = has_next
+
+	@property
+	def prev_cursor(self):
+		if not self.has_prev or not self.items:
+			return None
+		return encode_cursor(self.items[0].timestamp, self.items[0].id)
+
+	@property
+	def next_cursor(self):
+		if not self.has_next or not self.items:
+			return None
+		return encode_cursor(self.items[-1].timestamp, self.items[-1].id)
+
+class KeysetQuery(BaseQuery):
+	"""Query class for timestamped models that pages by (timestamp, id) with
+	WHERE/LIMIT instead of OFFSET, so the last page costs the same as the
+	first one and no COUNT query is needed."""
+	_keyset = None
+
+	def keyset_by(self, timestamp, id):
+		"""Pages on other columns than the entity's own timestamp and id,
+		e.g. the ones of a table that is joined in and indexed for it."""
+		q = self._clone()
+		q._keyset = (timestamp, id)
+		return q
+
+	def paginate_keyset(self, before=None, after=None, per_page=20, error_out=True):
+		"""Returns up to per_page items older than the `before` cursor, or
+		newer than the `after` cursor, newest first."""
+		if self._keyset is not None:
+			timestamp, id = self._keyset
+		else:
+			entity = self.column_descriptions[0]['entity']
+			timestamp, id = entity.timestamp, entity.id
+		try:
+			before = decode_cursor(before) if before else None
+			after = decode_cursor(after) if after else None
+		except ValueError:
+			if error_out:
+				abort(404)
+			before = after = None
+
+		q = self.order_by(None)
+		if after is not None:
+			# walk back towards newer rows, then flip them into display order
+			q = q.filter(or_(timestamp > after[0], and_(timestamp == after[0], id > after[1])))
+			items = q.order_by(timestamp.asc(), id.asc()).limit(per_page + 1).all()
+			if not items:
+				return self.paginate_keyset(per_page=per_page)
+			has_prev = len(items) > per_page
+			items = items[:per_page]
+			items.reverse()
+			return KeysetPagination(items, has_prev, True)
+
+		if before is not None:
+			q = q.filter(or_(timestamp < before[0], and_(timestamp == before[0], id < before[1])))
+		items = q.order_by(timestamp.desc(), id.desc()).limit(per_page + 1).all()
+		return KeysetPagination(items[:per_page], before is not None, len(items) > per_page)
@@ -0,0 +1,96 @@
+import atexit
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import bindparam
+
+class PresenceTracker(object):
+	"""Keeps the last-seen time of active users in memory and writes them out
+	in one batched UPDATE every PRESENCE_INTERVAL seconds, so a request from a
+	logged-in user does not have to commit anything."""
+	def __init__(self, app=None):
+		self.app = None
+		self.interval = 60
+		self.pending = {}	# user id -> last request time, not yet written
+		self.flushing = {}	# entries being written by flush() right now
+		self.lock = threading.Lock()
+		self.thread = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		self.interval = app.config.get('PRESENCE_INTERVAL', 60)
+		atexit.register(self.flush_on_exit)
+
+	def touch(self, user_id, now=None):
+		"""Records that the user was seen, without touching the database."""
+		with self.lock:
+			self.pending[user_id] = now or datetime.utcnow()
+		if self.thread is None and not self.app.testing:
+			self.start()
+
+	def last_seen(self, user):
+		"""The newest known last-seen time of the user, including the one
+		that is still waiting to be written."""
+		with self.lock:
+			seen = self.pending.get(user.id) or self.flushing.get(user.id)
+		if seen is not None and (user.last_seen is None or seen > user.last_seen):
+			return seen
+		return user.last_seen
+
+	def flush(self):
+		"""Writes every pending entry with a single executemany UPDATE.
+		Returns the number of users written."""
+		from .models import User
+		from app import db, users
+		with self.lock:
+			self.flushing, self.pending = self.pending, {}
+		if not self.flushing:
+			return 0
+		try:
+			table = User.__table__
+			db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(last_seen=bindparam('_seen')),
+							   [{'_id': user_id, '_seen': seen} for user_id, seen in self.flushing.items()])
+			db.session.commit()
+			for user_id in self.flushing:
+				users.invalidate(user_id)
+			return len(self.flushing)
+		except Exception:
+			db.session.rollback()
+			# put the entries back unless the user was seen again meanwhile
+			with self.lock:
+				for user_id, seen in self.flushing.items():
+					self.pending.setdefault(user_id, seen)
+			raise
+		finally:
+			self.flushing = {}
+
+	def start(self):
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.run, name='presence-flusher')
+			self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			with self.app.app_context():
+				try:
+					self.flush()
+				except Exception:
+					self.app.logger.exception('could not write last seen times')
+				finally:
+					from app import db
+					db.session.remove()
+
+	def flush_on_exit(self):
+		if self.app is None or not self.pending:
+			return
+		with self.app.app_context():
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('could not write last seen times')
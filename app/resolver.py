@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_app_context
+from flask_sqlalchemy import models_committed
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+class UserResolver(object):
+	"""Looks users up by id or nickname. Within a request every nickname is
+	resolved once and users come out of the session's identity map; across
+	requests an optional LRU cache (USER_CACHE_SIZE entries, each kept for
+	USER_CACHE_TTL seconds) remembers nickname -> id and the column values
+	of recently seen users, so hot profiles are served without a query."""
+	def __init__(self, app=None):
+		self.size = 0
+		self.ttl = 0
+		self.nicknames = OrderedDict()	# nickname -> (user id, expiry)
+		self.snapshots = OrderedDict()	# user id -> (column values, expiry)
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.size = app.config.get('USER_CACHE_SIZE', 0)
+		self.ttl = app.config.get('USER_CACHE_TTL', 0)
+		models_committed.connect(self.on_models_committed, sender=app)
+
+	def get(self, id):
+		"""Returns the user with the given id, or None."""
+		from .models import User
+		from app import db
+		user = db.session.identity_map.get(inspect(User).identity_key_from_primary_key([id]))
+		if user is not None:
+			return user
+		values = self._lookup(self.snapshots, id)
+		if values is not None:
+			return self._attach(values)
+		user = User.query.get(id)
+		if user is not None:
+			self.remember(user)
+		return user
+
+	def by_nickname(self, nickname):
+		"""Returns the user with the given nickname, or None."""
+		from .models import User
+		ids = g.setdefault('user_ids', {}) if has_app_context() else {}
+		id = ids.get(nickname)
+		if id is None:
+			id = self._lookup(self.nicknames, nickname)
+		user = self.get(id) if id is not None else None
+		if user is None or user.nickname != nickname:
+			user = User.query.filter_by(nickname=nickname).first()
+			if user is None:
+				return None
+			self.remember(user)
+		ids[nickname] = user.id
+		return user
+
+	def remember(self, user):
+		if not self.size:
+			return
+		values = dict((attr.key, getattr(user, attr.key)) for attr in inspect(type(user)).column_attrs)
+		self._store(self.snapshots, user.id, values)
+		self._store(self.nicknames, user.nickname, user.id)
+
+	def invalidate(self, user_id):
+		"""Forgets everything cached about a user, e.g. after a rename."""
+		with self.lock:
+			entry = self.snapshots.pop(user_id, None)
+			if entry is not None:
+				self.nicknames.pop(entry[0]['nickname'], None)
+		if has_app_context():
+			ids = g.get('user_ids', {})
+			for nickname in [n for n, i in ids.items() if i == user_id]:
+				del ids[nickname]
+
+	def on_models_committed(self, sender, changes):
+		from .models import User
+		for obj, operation in changes:
+			if isinstance(obj, User) and inspect(obj).identity is not None:
+				self.invalidate(inspect(obj).identity[0])
+
+	def _attach(self, values):
+		"""Turns cached column values back into a persistent User of the
+		current session without going to the database."""
+		from .models import User
+		from app import db
+		user = inspect(User).class_manager.new_instance()
+		for key, value in values.items():
+			set_committed_value(user, key, value)
+		make_transient_to_detached(user)
+		db.session.add(user)
+		return user
+
+	def _lookup(self, cache, key):
+		if not self.size:
+			return None
+		with self.lock:
+			entry = cache.get(key)
+			if entry is None:
+				return None
+			if entry[1] < time.time():
+				del cache[key]
+				return None
+			cache.move_to_end(key)
+			return entry[0]
+
+	def _store(self, cache, key, value):
+		with self.lock:
+			cache[key] = (value, time.time() + self.ttl)
+			cache.move_to_end(key)
+			while len(cache) > self.size:
+				cache.popitem(last=False)
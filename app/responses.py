@@ -0,0 +1,78 @@
+import zlib
+from flask import current_app, get_flashed_messages, render_template, request, stream_with_context
+
+class deferred(object):
+	"""Stands in for a value that is computed on first use. Handing a page
+	query to a template this way lets a streamed page send everything
+	above the query before it runs."""
+	def __init__(self, compute):
+		self.compute = compute
+
+	def __getattr__(self, name):
+		value = self.compute()
+		self.__dict__.update(value=value, compute=lambda: value)
+		return getattr(value, name)
+
+def render_page(template, **context):
+	"""render_template(), streamed in chunks of STREAM_BUFFER template
+	events when STREAM_TEMPLATES is set."""
+	app = current_app._get_current_object()
+	if not app.config.get('STREAM_TEMPLATES'):
+		return render_template(template, **context)
+	app.update_template_context(context)
+	stream = app.jinja_env.get_template(template).stream(context)
+	stream.enable_buffering(app.config.get('STREAM_BUFFER', 5))
+	stream = stream_with_context(stream)
+	# the session is saved before a streamed body renders, so the flashes
+	# are popped now and the template gets them from the request context.
+	# stream_with_context() reopens the session, which is why this comes
+	# after it
+	get_flashed_messages(with_categories=True)
+	return app.response_class(stream)
+
+class Compressor(object):
+	"""gzip encodes responses for clients that accept it. Only mimetypes in
+	COMPRESS_MIMETYPES are compressed, and only when they are at least
+	COMPRESS_MIN_SIZE bytes; streamed pages are compressed chunk by chunk,
+	flushing after each one so they still arrive early."""
+	def __init__(self, app=None):
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.enabled = app.config.get('COMPRESS_ENABLED', True)
+		self.level = app.config.get('COMPRESS_LEVEL', 6)
+		self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+		self.mimetypes = app.config.get('COMPRESS_MIMETYPES', ['text/html'])
+		app.after_request(self.after_request)
+
+	def after_request(self, response):
+		if not self.enabled or response.status_code < 200 or response.status_code >= 300 \
+				or response.mimetype not in self.mimetypes or 'Content-Encoding' in response.headers \
+				or not request.accept_encodings['gzip']:
+			return response
+		response.vary.add('Accept-Encoding')
+		if response.is_streamed:
+			response.response = self.compress_stream(response.iter_encoded())
+			response.headers.pop('Content-Length', None)
+		else:
+			data = response.get_data()
+			if len(data) < self.min_size:
+				return response
+			response.set_data(self.compress(data))
+		response.headers['Content-Encoding'] = 'gzip'
+		return response
+
+	def compressor(self):
+		# wbits 31 is zlib's gzip container
+		return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+	def compress(self, data):
+		compressor = self.compressor()
+		return compressor.compress(data) + compressor.flush()
+
+	def compress_stream(self, chunks):
+		compressor = self.compressor()
+		for chunk in chunks:
+			yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		yield compressor.flush()
@@ -0,0 +1,104 @@
+import os
+import threading
+from flask_sqlalchemy import models_committed
+from sqlalchemy import inspect
+
+class SearchIndex(object):
+	"""Full text search of posts and users through on-disk Whoosh indexes
+	under WHOOSH_BASE. The indexes are updated as posts and users are
+	committed; db_reindex.py rebuilds them from the database."""
+	def __init__(self, app=None):
+		self.app = None
+		self.indexes = {}
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		models_committed.connect(self.on_models_committed, sender=app)
+
+	def schemas(self):
+		from whoosh.fields import Schema, ID, TEXT
+		from whoosh.analysis import StemmingAnalyzer
+		return {
+			'post': Schema(id=ID(stored=True, unique=True), body=TEXT(analyzer=StemmingAnalyzer())),
+			'user': Schema(id=ID(stored=True, unique=True), nickname=TEXT(field_boost=2.0), about_me=TEXT(analyzer=StemmingAnalyzer())),
+		}
+
+	def index(self, name):
+		"""Opens (or creates) the index for the given model name."""
+		from whoosh import index
+		path = os.path.join(self.app.config['WHOOSH_BASE'], name)
+		with self.lock:
+			if path not in self.indexes:
+				if index.exists_in(path):
+					self.indexes[path] = index.open_dir(path)
+				else:
+					if not os.path.exists(path):
+						os.makedirs(path)
+					self.indexes[path] = index.create_in(path, self.schemas()[name])
+			return self.indexes[path]
+
+	def document(self, obj):
+		from .models import Post, User
+		if isinstance(obj, Post):
+			return 'post', {'id': str(obj.id), 'body': obj.body or ''}
+		if isinstance(obj, User):
+			return 'user', {'id': str(obj.id), 'nickname': obj.nickname or '', 'about_me': obj.about_me or ''}
+		return None, None
+
+	def on_models_committed(self, sender, changes):
+		from whoosh.writing import AsyncWriter
+		from .models import Post, User
+		writers = {}
+		for obj, operation in changes:
+			if not isinstance(obj, (Post, User)):
+				continue
+			name = 'post' if isinstance(obj, Post) else 'user'
+			if name not in writers:
+				writers[name] = AsyncWriter(self.index(name))
+			if operation == 'delete':
+				writers[name].delete_by_term('id', str(inspect(obj).identity[0]))
+			else:
+				writers[name].update_document(**self.document(obj)[1])
+		for writer in writers.values():
+			writer.commit()
+
+	def search(self, model, fields, query, limit, base=None):
+		"""Returns the model instances matching the query, best match first.
+		They are loaded through the base query, model.query by default."""
+		from whoosh.qparser import MultifieldParser, OrGroup
+		ix = self.index(model.__tablename__)
+		with ix.searcher() as searcher:
+			parsed = MultifieldParser(fields, ix.schema, group=OrGroup).parse(query)
+			ids = [int(hit['id']) for hit in searcher.search(parsed, limit=limit)]
+		if not ids:
+			return []
+		found = dict((obj.id, obj) for obj in (base or model.query).filter(model.id.in_(ids)))
+		return [found[id] for id in ids if id in found]
+
+	def search_posts(self, query, limit=None):
+		from .models import Post
+		return self.search(Post, ['body'], query, limit or self.app.config['MAX_SEARCH_RESULTS'], Post.for_display(Post.query))
+
+	def search_users(self, query, limit=None):
+		from .models import User
+		return self.search(User, ['nickname', 'about_me'], query, limit or self.app.config['MAX_SEARCH_RESULTS'])
+
+	def reindex(self, batch_size=1000):
+		"""Rebuilds both indexes from scratch out of the database."""
+		from whoosh.writing import CLEAR
+		from .models import Post, User
+		for model in [Post, User]:
+			writer = self.index(model.__tablename__).writer()
+			last_id = 0
+			while True:
+				batch = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+				if not batch:
+					break
+				for obj in batch:
+					writer.add_document(**self.document(obj)[1])
+				last_id = batch[-1].id
+			# CLEAR drops the old segments, keeping only what was added here
+			writer.commit(mergetype=CLEAR)
@@ -0,0 +1,31 @@
+// Keeps the server rendered <time class="moment-from-now"> tags fresh.
+(function () {
+    if (!window.Intl || !Intl.RelativeTimeFormat) {
+        return;
+    }
+    var format = new Intl.RelativeTimeFormat(document.documentElement.lang || undefined, {numeric: 'auto'});
+    var units = [['year', 31536000], ['month', 2592000], ['day', 86400], ['hour', 3600], ['minute', 60], ['second', 1]];
+
+    function fromNow(date) {
+        var seconds = (date - Date.now()) / 1000;
+        for (var i = 0; i < units.length; i++) {
+            if (Math.abs(seconds) >= units[i][1] || units[i][0] === 'second') {
+                return format.format(Math.round(seconds / units[i][1]), units[i][0]);
+            }
+        }
+    }
+
+    function refresh() {
+        var tags = document.querySelectorAll('time.moment-from-now');
+        for (var i = 0; i < tags.length; i++) {
+            tags[i].textContent = fromNow(new Date(tags[i].getAttribute('datetime')));
+        }
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', refresh);
+    } else {
+        refresh();
+    }
+    setInterval(refresh, 60000);
+})();
@@ -0,0 +1,176 @@
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from flask import current_app
+from sqlalchemy import func, select
+from .database import BATCH
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# two-hop paths expanded at once by the numpy version, which bounds the
+# memory a run takes on a large graph
+CHUNK_PATHS = 5000000
+
+def load_edges():
+	"""Reads the followers table in one pass, in index order, as two parallel
+	int arrays sorted by follower. Users following themselves add nothing
+	to anybody's suggestions and are left out."""
+	from app import db
+	from .models import followers
+	sources, targets = array('i'), array('i')
+	rows = db.session.connection().execute(select([followers.c.follower_id, followers.c.followed_id])
+		.where(followers.c.follower_id != followers.c.followed_id)
+		.order_by(followers.c.follower_id, followers.c.followed_id))
+	for follower_id, followed_id in rows:
+		sources.append(follower_id)
+		targets.append(followed_id)
+	return sources, targets
+
+def compute(sources, targets, user_ids, k):
+	"""The k users followed by most of the users each of user_ids follows,
+	leaving out the ones already followed, as {user id: [(suggested id,
+	score), ...]} best first, ties going to the lower id. Users with no
+	suggestion are left out. Uses numpy when it is installed."""
+	if numpy is not None:
+		return compute_numpy(sources, targets, user_ids, k)
+	return compute_python(sources, targets, user_ids, k)
+
+def compute_python(sources, targets, user_ids, k):
+	followed = {}
+	for source, target in zip(sources, targets):
+		followed.setdefault(source, array('i')).append(target)
+	suggestions = {}
+	for user_id in user_ids:
+		mine = followed.get(user_id)
+		if not mine:
+			continue
+		known = set(mine)
+		known.add(user_id)
+		scores = Counter()
+		for followed_id in mine:
+			scores.update(followed.get(followed_id, ()))
+		best = heapq.nsmallest(k, ((-score, id) for id, score in scores.items() if id not in known))
+		if best:
+			suggestions[user_id] = [(id, -score) for score, id in best]
+	return suggestions
+
+def expand(starts, lengths):
+	"""For ranges [start, start + length) of an array, the index of the
+	range each position comes from and the positions themselves."""
+	owners = numpy.repeat(numpy.arange(len(starts)), lengths)
+	offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+	return owners, numpy.repeat(starts, lengths) + offsets
+
+def compute_numpy(sources, targets, user_ids, k):
+	if not len(sources):
+		return {}
+	src = numpy.frombuffer(sources, dtype=numpy.int32).astype(numpy.int64)
+	dst = numpy.frombuffer(targets, dtype=numpy.int32).astype(numpy.int64)
+	n = int(max(src.max(), dst.max())) + 1
+	# the users followed by v are dst[start[v]:start[v + 1]]
+	start = numpy.searchsorted(src, numpy.arange(n + 1))
+	degree = numpy.diff(start)
+	users = numpy.unique(numpy.array(list(user_ids), dtype=numpy.int64))
+	users = users[(users >= 0) & (users < n)]
+	users = users[degree[users] > 0]
+	# split the users so that no chunk expands many more than CHUNK_PATHS paths
+	paths = numpy.concatenate(([0], numpy.cumsum(degree[dst])))
+	per_user = paths[start[users + 1]] - paths[start[users]]
+	chunks = numpy.cumsum(per_user) // CHUNK_PATHS
+	suggestions = {}
+	for chunk in numpy.unique(chunks):
+		suggestions.update(suggest_chunk(users[chunks == chunk], src, dst, start, degree, n, k))
+	return suggestions
+
+def suggest_chunk(users, src, dst, start, degree, n, k):
+	# first hop: the users each user follows, second hop: whom those follow
+	owners, edges = expand(start[users], degree[users])
+	viewers, middle = users[owners], dst[edges]
+	owners, edges = expand(start[middle], degree[middle])
+	who, candidates = viewers[owners], dst[edges]
+	keep = candidates != who
+	keys, scores = numpy.unique(who[keep] * n + candidates[keep], return_counts=True)
+	# leave out the users already followed; their keys are sorted already
+	followed = viewers * n + middle
+	found = numpy.searchsorted(followed, keys)
+	keep = followed[numpy.minimum(found, len(followed) - 1)] != keys
+	keys, scores = keys[keep], scores[keep]
+	if not len(keys):
+		return {}
+	who, candidates = keys // n, keys % n
+	# best first within each user: the keys are in (user, candidate) order,
+	# which a stable sort on (user, score) keeps among equal scores
+	top_score = int(scores.max())
+	order = numpy.argsort(who * (top_score + 1) + (top_score - scores), kind='mergesort')
+	who, candidates, scores = who[order], candidates[order], scores[order]
+	positions = numpy.arange(len(who))
+	first = numpy.concatenate(([True], who[1:] != who[:-1]))
+	rank = positions - numpy.maximum.accumulate(numpy.where(first, positions, 0))
+	top = rank < k
+	suggestions = {}
+	for user_id, candidate, score in zip(who[top].tolist(), candidates[top].tolist(), scores[top].tolist()):
+		suggestions.setdefault(user_id, []).append((candidate, score))
+	return suggestions
+
+def with_followers(sources, targets, user_ids):
+	"""user_ids and every user who follows one of them: the users whose
+	suggestions change when the follows of user_ids do."""
+	ids = set(user_ids)
+	return ids | set(source for source, target in zip(sources, targets) if target in ids)
+
+def summarize(ids):
+	# count, sum and sum of squares tell two follow lists apart without
+	# reading them back row by row
+	return len(ids), sum(ids), sum(id * id for id in ids)
+
+def followed_summaries(sources, targets, user_ids):
+	"""{user id: summarize(ids they follow)} for user_ids, out of the edge
+	arrays."""
+	return dict((user_id, summarize(targets[bisect_left(sources, user_id):bisect_right(sources, user_id)])) for user_id in user_ids)
+
+def refresh(all_users=False):
+	"""Recomputes and stores the suggestions of the users marked stale and
+	of their followers, or of every user, and returns how many users were
+	refreshed. The edges are read in one scan of the followers table."""
+	from app import db
+	from .models import User, Suggestion, followers
+	user = User.__table__
+	stale = [id for id, in db.session.query(User.id).filter(User.suggestions_stale == True)]
+	if not stale and not all_users:
+		return 0
+
+	sources, targets = load_edges()
+	if all_users:
+		user_ids = [id for id, in db.session.query(User.id)]
+	else:
+		user_ids = sorted(with_followers(sources, targets, stale))
+	suggestions = compute(sources, targets, user_ids, current_app.config['SUGGESTIONS_PER_USER'])
+	# the rows are replaced and the flags cleared in one transaction, so a
+	# run that fails leaves its users marked for the next one
+	table = Suggestion.__table__
+	for i in range(0, len(user_ids), BATCH):
+		db.session.execute(table.delete().where(table.c.user_id.in_(user_ids[i:i + BATCH])))
+	rows = [{'user_id': user_id, 'rank': rank, 'suggested_id': suggested_id, 'score': score}
+			for user_id, best in suggestions.items() for rank, (suggested_id, score) in enumerate(best)]
+	if rows:
+		db.session.execute(table.insert(), rows)
+	# users who followed or unfollowed since the edges were read stay marked
+	used = followed_summaries(sources, targets, stale)
+	followed_id = followers.c.followed_id
+	for i in range(0, len(stale), BATCH):
+		batch = stale[i:i + BATCH]
+		current = dict((user_id, summarize(())) for user_id in batch)
+		for user_id, count, total, squares in db.session.query(followers.c.follower_id,
+				func.count(), func.sum(followed_id), func.sum(followed_id * followed_id)) \
+				.filter(followers.c.follower_id.in_(batch)) \
+				.filter(followers.c.follower_id != followed_id) \
+				.group_by(followers.c.follower_id):
+			current[user_id] = (count, total, squares)
+		unchanged = [user_id for user_id in batch if current[user_id] == used[user_id]]
+		if unchanged:
+			db.session.execute(user.update().where(user.c.id.in_(unchanged)).values(suggestions_stale=False))
+	db.session.commit()
+	return len(user_ids)
@@ -0,0 +1,149 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from flask_sqlalchemy import models_committed
+from sqlalchemy import inspect
+
+# fuzzy matches scoring lower than this are not worth suggesting
+FUZZY_THRESHOLD = 0.2
+
+def trigrams(text):
+	padded = ' ' + text.lower() + ' '
+	return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class NicknameIndex(object):
+	"""In-memory nickname index for typeahead: a sorted list of lower cased
+	nicknames answers prefix queries by bisection, and trigram postings
+	answer fuzzy ones. It is loaded with one query on first use, kept up to
+	date from committed users and reloaded every TYPEAHEAD_REFRESH seconds
+	to pick up users created by other processes; one request reloads it
+	while the others go on with the old one."""
+	def __init__(self, app=None):
+		self.app = None
+		self.lock = threading.Lock()
+		self.reloading = threading.Lock()
+		self.clear()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		models_committed.connect(self.on_models_committed, sender=app)
+
+	def clear(self):
+		with self.lock:
+			self.names = []		# sorted (lower cased nickname, user id)
+			self.nicknames = {}	# user id -> nickname
+			self.sizes = {}		# user id -> number of trigrams in the nickname
+			self.postings = defaultdict(set)	# trigram -> user ids
+			self.loaded_at = None
+
+	def warm(self):
+		from .models import User
+		from app import db
+		rows = db.session.query(User.id, User.nickname).all()
+		with self.lock:
+			self.names = []
+			self.nicknames = {}
+			self.sizes = {}
+			self.postings = defaultdict(set)
+			for id, nickname in rows:
+				if nickname:
+					self._add(id, nickname)
+			self.names.sort()
+			self.loaded_at = time.time()
+
+	def stale(self):
+		return self.loaded_at is None or time.time() - self.loaded_at > self.app.config.get('TYPEAHEAD_REFRESH', 300)
+
+	def ensure_loaded(self):
+		if not self.stale():
+			return
+		# only one thread reloads; the others answer from the old index, or
+		# wait for the first load when there is none yet
+		if self.reloading.acquire(self.loaded_at is None):
+			try:
+				if self.stale():
+					self.warm()
+			finally:
+				self.reloading.release()
+
+	def _add(self, id, nickname):
+		self.nicknames[id] = nickname
+		self.names.append((nickname.lower(), id))
+		self._add_trigrams(id, nickname)
+
+	def _add_trigrams(self, id, nickname):
+		grams = trigrams(nickname)
+		self.sizes[id] = len(grams)
+		for trigram in grams:
+			self.postings[trigram].add(id)
+
+	def _remove(self, id):
+		nickname = self.nicknames.pop(id, None)
+		if nickname is None:
+			return
+		del self.sizes[id]
+		i = bisect_left(self.names, (nickname.lower(), id))
+		if i < len(self.names) and self.names[i] == (nickname.lower(), id):
+			del self.names[i]
+		for trigram in trigrams(nickname):
+			self.postings[trigram].discard(id)
+
+	def update(self, id, nickname):
+		with self.lock:
+			if self.loaded_at is None:
+				return
+			self._remove(id)
+			if nickname:
+				self.nicknames[id] = nickname
+				insort(self.names, (nickname.lower(), id))
+				self._add_trigrams(id, nickname)
+
+	def remove(self, id):
+		with self.lock:
+			self._remove(id)
+
+	def on_models_committed(self, sender, changes):
+		from .models import User
+		for obj, operation in changes:
+			if isinstance(obj, User) and self.loaded_at is not None:
+				if operation == 'delete':
+					self.remove(inspect(obj).identity[0])
+				else:
+					self.update(obj.id, obj.nickname)
+
+	def prefix(self, query, limit):
+		"""Ids of the users whose nickname starts with query, alphabetically."""
+		query = query.lower()
+		ids = []
+		with self.lock:
+			i = bisect_left(self.names, (query,))
+			while i < len(self.names) and len(ids) < limit and self.names[i][0].startswith(query):
+				ids.append(self.names[i][1])
+				i += 1
+		return ids
+
+	def fuzzy(self, query, limit):
+		"""Ids of the users whose nickname shares the most trigrams with the
+		query, best first."""
+		grams = trigrams(query)
+		shared = Counter()
+		with self.lock:
+			for trigram in grams:
+				shared.update(self.postings.get(trigram, ()))
+			# rank by Jaccard similarity of the trigram sets
+			scores = [(count / float(len(grams) + self.sizes[id] - count), id) for id, count in shared.items()]
+		return [id for score, id in heapq.nlargest(limit, scores) if score >= FUZZY_THRESHOLD]
+
+	def complete(self, query, limit=10):
+		"""Prefix matches first, then fuzzy matches to fill up to limit."""
+		self.ensure_loaded()
+		ids = self.prefix(query, limit)
+		if len(ids) < limit:
+			seen = set(ids)
+			ids += [id for id in self.fuzzy(query, limit) if id not in seen][:limit - len(ids)]
+		with self.lock:
+			return [(id, self.nicknames[id]) for id in ids if id in self.nicknames]
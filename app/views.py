@@ -1,37 +1,49 @@
-from flask import render_template, flash, redirect, session, url_for, request, g
+from flask import Blueprint, current_app, render_template, flash, redirect, session, url_for, request, g, jsonify
 from flask_login import login_user, logout_user, current_user, login_required
 from flask_babel import gettext
-from app import app, db, lm, oid, babel
-from .forms import LoginForm, EditForm, PostForm, SearchForm
+from app import db, lm, oid, babel, presence, users, search_index, nickname_index, graph
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS
-from .models import User, Post, UserPostHearts
+from .models import User, Post, UserPostHearts, FollowerNotification, Suggestion
+from .decorators import conditional
+from .responses import deferred, render_page
 from .emails import follower_notification
 from config import LANGUAGES
 
+main = Blueprint('main', __name__)
+
+# the forms (and flask_wtf behind them) are imported by the views that use
+# them, so building the application for a script does not load them
+
 @lm.user_loader
 def load_user(id):
-	return User.query.get(int(id))
+	return users.get(int(id))
 
 @babel.localeselector
 def get_locale():
 	return request.accept_languages.best_match(LANGUAGES.keys())
 
-@app.before_request
+@main.before_app_request
 def before_request():
 	g.user = current_user
 	if g.user.is_authenticated:
-		g.user.last_seen = datetime.utcnow()
-		db.session.add(g.user)
-		db.session.commit()
+		presence.touch(g.user.id)
+		from .forms import SearchForm
 		g.search_form = SearchForm()
 	g.locale = get_locale()
 
-@app.route('/login', methods=['GET', 'POST'])
-@oid.loginhandler
+@main.route('/login', methods=['GET', 'POST'])
 def login():
+	# wrapped per request instead of decorated, so that flask_openid is
+	# only imported once somebody logs in
+	return oid.loginhandler(login_form)()
+
+def login_form():
 	if g.user is not None and g.user.is_authenticated:
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
+	from .forms import LoginForm
 	form=LoginForm()
 	if form.validate_on_submit():
 		session['remember me'] = form.remember_me.data
@@ -40,15 +52,14 @@ def login():
 	return render_template('login.html',
 							title="Sign In",
 							form=form,
-							providers=app.config['OPENID_PROVIDERS'])
+							providers=current_app.config['OPENID_PROVIDERS'])
 
-@oid.after_login
 def after_login(resp): # resp argument contains info returned by OpenID provider
 	if resp.email is None or resp.email == "": 
 		"""This is for validation. Valid email is required. If email was
 		not provided, user cannot log in."""
 		flash(gettext('Invalid login. Please try again.'))
-		return redirect(url_for('login'))
+		return redirect(url_for('.login'))
 	# search database for email provided. If email was not found,
 	# user will be considered new user and added to the database
 	user = User.query.filter_by(email=resp.email).first()
@@ -69,28 +80,56 @@ def after_login(resp): # resp argument contains info returned by OpenID provider
 		remember_me = session['remember_me']
 		session.pop('remember_me', None)
 	login_user(user, remember=remember_me) # register as a valid login
-	return redirect(request.args.get('next') or url_for('index'))
+	return redirect(request.args.get('next') or url_for('.index'))
+
+@oid.on_load
+def setup_openid(openid):
+	openid.after_login(after_login)
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
 	logout_user()
-	return redirect(url_for('index'))
+	return redirect(url_for('.index'))
 
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def not_found_error(error):
 	return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def internal_error(error):
 	db.session.rollback()
 	return render_template('500.html'), 500
 
+def who_to_follow(exclude=None):
+	"""The current user's stored suggestions, less the users followed since
+	they were computed (and exclude, the profile being shown)."""
+	shown = current_app.config['SUGGESTIONS_SHOWN']
+	if not shown:
+		return []
+	candidates = [user for user in Suggestion.for_user(g.user.id, 2 * shown) if user.id != exclude]
+	following = graph.are_following((g.user.id, user.id) for user in candidates)
+	return [user for user, followed in zip(candidates, following) if not followed][:shown]
+
+def viewer_tag():
+	# the viewer's follows decide the timeline and which suggestions show
+	shown = current_app.config['SUGGESTIONS_SHOWN']
+	return (g.user.id, g.user.nickname, g.user.followed_count, g.locale,
+			Suggestion.ids_for_user(g.user.id, 2 * shown) if shown else ())
+
+def index_tag():
+	page = Post.page_summary(g.user.followed_posts(authors=False),
+			request.args.get('before'), request.args.get('after'), POSTS_PER_PAGE)
+	# the home page shows the viewer's heart or unheart link on every post
+	hearted = UserPostHearts.hearted_by(g.user.id, [row[0] for row in page[0]])
+	return (viewer_tag(), page, tuple(sorted(hearted)))
+
 # webpage controllers
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
-@app.route('/index/<int:page>', methods=['GET', 'POST'])
+@main.route('/', methods=['GET', 'POST'])
+@main.route('/index', methods=['GET', 'POST'])
 @login_required
-def index(page=1):
+@conditional(index_tag)
+def index():
+	from .forms import PostForm
 	form = PostForm()
 
 	if form.validate_on_submit():
@@ -100,77 +139,118 @@ def index(page=1):
 					author=g.user)
 
 		db.session.add(post)
+		if current_app.config['TIMELINE_ENABLED']:
+			post.fan_out()
 		db.session.commit()
 
 		flash(gettext('Your post is now live!'))
 
-		return redirect(url_for('index'))
-	posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
-	
-	return render_template("index.html",
-							title='Home',
-							form=form,
-							posts=posts)
+		return redirect(url_for('.index'))
+
+	def timeline():
+		posts = g.user.followed_posts().paginate_keyset(request.args.get('before'), request.args.get('after'), POSTS_PER_PAGE, False)
+		Post.load_hearts(posts.items, g.user)
+		return posts
+
+	return render_page("index.html",
+						title='Home',
+						form=form,
+						suggestions=who_to_follow(),
+						posts=deferred(timeline))
 
-@app.route('/user/<nickname>')
-@app.route('/user/<nickname>/<int:page>')
+def user_tag(nickname):
+	user = users.by_nickname(nickname)
+	if user is None:
+		return None
+	# last seen is shown to the minute
+	last_seen = presence.last_seen(user)
+	return (viewer_tag(), user.id, user.nickname, user.email_hash, user.about_me, user.follower_count,
+			last_seen and last_seen.replace(second=0, microsecond=0),
+			g.user.is_following(user), tuple(graph.followed_by_followed(g.user.id, user.id)),
+			Post.page_summary(user.profile_posts(authors=False),
+			request.args.get('before'), request.args.get('after'), POSTS_PER_PAGE))
+
+@main.route('/user/<nickname>')
 @login_required
-def user(nickname, page=1):
-	user = User.query.filter_by(nickname=nickname).first()
+@conditional(user_tag)
+def user(nickname):
+	user = users.by_nickname(nickname)
 
 	if user == None:
 		#flash(gettext('User %(nickname)s not found.', nickname=nickname))
-		return redirect(url_for('index'))
-
-	posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, POSTS_PER_PAGE, False)
-
-	return render_template('user.html',
-							user=user,
-							posts=posts)
-
-@app.route('/edit', methods=['GET', 'POST'])
+		return redirect(url_for('.index'))
+
+	posts = deferred(lambda: user.profile_posts().paginate_keyset(request.args.get('before'), request.args.get('after'), POSTS_PER_PAGE, False))
+	# the follow button asks the database: a follow made by another process
+	# can be missing from the cached graph, and acting on that would fail
+	following = g.user.is_following(user)
+	followed_by = [id for id in graph.followed_by_followed(g.user.id, user.id) if id not in (g.user.id, user.id)]
+	shown = current_app.config['FOLLOWED_BY_SHOWN']
+
+	return render_page('user.html',
+						user=user,
+						last_seen=presence.last_seen(user),
+						following=following,
+						followed_by=[u for u in map(users.get, followed_by[:shown]) if u is not None],
+						followed_by_others=max(len(followed_by) - shown, 0),
+						suggestions=who_to_follow(exclude=user.id),
+						posts=posts)
+
+@main.route('/edit', methods=['GET', 'POST'])
 @login_required
 def edit():
+	from .forms import EditForm
 	form = EditForm(g.user.nickname)
 	if form.validate_on_submit():
 		g.user.nickname = form.nickname.data
 		g.user.about_me = form.about_me.data
+		g.user.notify_digest = form.notify_digest.data
 		db.session.add(g.user)
 		db.session.commit()
 		flash(gettext('Your changes have been saved.'))
-		return redirect(url_for('edit'))
+		return redirect(url_for('.edit'))
 	elif request.method != "POST":
 		form.nickname.data = g.user.nickname
 		form.about_me.data = g.user.about_me
+		form.notify_digest.data = g.user.notify_digest
 	return render_template('edit.html', form=form)
 
-@app.route('/delete/<int:id>')
+@main.route('/delete/<int:id>')
 @login_required
 def delete(id):
 	post = Post.query.get(id)
 	if post is None:
 		flash(gettext('Post not found'))
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
 
 	if post.author.id != g.user.id:
 		flash(gettext('You cannot delete this post.'))
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
+	if not post.claim():
+		flash(gettext('Post not found'))
+		return redirect(url_for('.index'))
+	if current_app.config['TIMELINE_ENABLED']:
+		post.remove_from_timelines()
 	db.session.delete(post)
 	db.session.commit()
 	flash(gettext('Your post has been deleted.'))
-	return redirect(url_for('index'))
+	return redirect(url_for('.index'))
 
-@app.route('/edit_post/<int:id>', methods=['GET', 'POST'])
+@main.route('/edit_post/<int:id>', methods=['GET', 'POST'])
 @login_required
-def edit_post(id, page=1):
+def edit_post(id):
 	post = Post.query.get(id)
+	from .forms import PostForm
 	form = PostForm(obj=post)
 	
 	if request.method == 'GET':
 		form.post.data = post.body
 
-		db.session.delete(post)
-		db.session.commit()
+		if post.claim():
+			if current_app.config['TIMELINE_ENABLED']:
+				post.remove_from_timelines()
+			db.session.delete(post)
+			db.session.commit()
 
 	if request.method == 'POST' and form.validate_on_submit():
 		new_post = request.form['post']
@@ -180,101 +260,145 @@ def edit_post(id, page=1):
 					author=g.user)
 
 		db.session.add(to_post)
+		if current_app.config['TIMELINE_ENABLED']:
+			to_post.fan_out()
 		db.session.commit()
 		flash(gettext('Post updated.'))
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
 
-	posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
+	posts = g.user.followed_posts().paginate_keyset(request.args.get('before'), request.args.get('after'), POSTS_PER_PAGE, False)
+	Post.load_hearts(posts.items, g.user)
 
 	return render_template('index.html', 
 							form=form,
 							posts=posts)
 
-@app.route('/heart_post/<int:id>', methods=['GET', 'POST'])
+@main.route('/heart_post/<int:id>', methods=['GET', 'POST'])
 @login_required
 def heart_post(id, page=1):
-	post_to_heart = Post.query.filter_by(id=id).first()
-	user_name = User.query.filter_by(nickname=g.user.nickname).first()
-	
+	post_to_heart = Post.query.get_or_404(id)
 	if not g.user.did_heart(post_to_heart):
-		heart = UserPostHearts(user_id=user_name.id, post_id=post_to_heart.id, timestamp=datetime.utcnow())
+		heart = UserPostHearts(user_id=g.user.id, post_id=post_to_heart.id, timestamp=datetime.utcnow())
 		db.session.add(heart)
-		db.session.commit()
-		return redirect(url_for('index'))
+		try:
+			db.session.commit()
+		except IntegrityError:
+			# a second click that raced the first one, which already counted
+			db.session.rollback()
+	return redirect(url_for('.index'))
 
 
-@app.route('/unheart_post/<int:id>', methods=['GET', 'POST'])
+@main.route('/unheart_post/<int:id>', methods=['GET', 'POST'])
 @login_required
 def unheart_post(id, page=1):
-	post = Post.query.filter_by(id=id).first()
-	post_to_unheart = UserPostHearts.query.filter_by(post_id=post.id).first()
-	user_name = User.query.filter_by(nickname=g.user.nickname).first()
-
-	if g.user.did_heart(post):
-		db.session.delete(post_to_unheart)
+	if UserPostHearts.remove(id, g.user.id):
 		db.session.commit()
-		return redirect(url_for('index'))
+	return redirect(url_for('.index'))
 
-@app.route('/follow/<nickname>')
+@main.route('/follow/<nickname>')
 @login_required
 def follow(nickname):
-	user  = User.query.filter_by(nickname=nickname).first()
+	user = users.by_nickname(nickname)
 	if user is None:
 		flash(gettext('User ' + nickname + ' not found.'))
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
 
 	if user == g.user:
 		flash(gettext('You can\'t follow yourself!'))
-		return redirect(url_for('user', nickname=nickname))
-
-	u = g.user.follow(user)
+		return redirect(url_for('.user', nickname=nickname))
+
+	digest = user.notify_digest
+	try:
+		u = g.user.follow(user)
+		if u is not None:
+			db.session.add(u)
+			if digest:
+				# picked up by the next run of send_digests.py
+				db.session.add(FollowerNotification(recipient_id=user.id, follower_id=g.user.id, timestamp=datetime.utcnow()))
+			if current_app.config['TIMELINE_ENABLED']:
+				db.session.flush()
+				g.user.rebuild_timeline()
+			db.session.commit()
+	except IntegrityError:
+		# a second click that raced the first one, which already followed
+		db.session.rollback()
+		u = None
 	if u is None:
 		flash(gettext('Cannot follow %(nickname)s.', nickname=nickname))
-		return redirect(url_for('user', nickname=nickname))
-
-	db.session.add(u)
-	db.session.commit()
+		return redirect(url_for('.user', nickname=nickname))
 
 	flash(gettext('You are now following %(nickname)s!', nickname=nickname))
-	follower_notification(user, g.user)
-	return redirect(url_for('user', nickname=nickname))
+	if not digest:
+		follower_notification(user, g.user)
+	return redirect(url_for('.user', nickname=nickname))
 
-@app.route('/unfollow/<nickname>')
+@main.route('/unfollow/<nickname>')
 @login_required
 def unfollow(nickname):
-	user = User.query.filter_by(nickname=nickname).first()
+	user = users.by_nickname(nickname)
 	if user is None:
 		flash(gettext('User ' + nickname + ' not found.'))
-		return redirect(url_for('index'))
+		return redirect(url_for('.index'))
 
 	if user == g.user:
 		flash(gettext('You can\'t unfollow yourself!'))
-		return redirect(url_for('user', nickname=nickname))
-
-	u = g.user.unfollow(user)
+		return redirect(url_for('.user', nickname=nickname))
+
+	try:
+		u = g.user.unfollow(user)
+		if u is not None:
+			db.session.add(u)
+			if current_app.config['TIMELINE_ENABLED']:
+				db.session.flush()
+				g.user.rebuild_timeline()
+			db.session.commit()
+	except StaleDataError:
+		# a second click that raced the first one, which already unfollowed
+		# and left no row to delete
+		db.session.rollback()
+		u = None
 	if u is None:
 		flash(gettext('Cannot unfollow %(nickname)s.', nickname=nickname))
-		return redirect(url_for('user', nickname=nickname))
-
-	db.session.add(u)
-	db.session.commit()
+		return redirect(url_for('.user', nickname=nickname))
 	flash(gettext('You have stopped following %(nickname)s.', nickname=nickname))
-	return redirect(url_for('user', nickname=nickname))
+	return redirect(url_for('.user', nickname=nickname))
 
-@app.route('/search', methods=['GET','POST'])
+@main.route('/search', methods=['GET','POST'])
 def search():
 	if not g.search_form.validate_on_submit():
 		flash(gettext('Invalid search.'))
-		return redirect(url_for('index'))
-	return redirect(url_for('search_results', query=g.search_form.search_user.data))
+		return redirect(url_for('.index'))
+	return redirect(url_for('.search_results', query=g.search_form.search_user.data))
 
-@app.route('/search_results/<query>')
+@main.route('/search_results/<query>')
 @login_required
 def search_results(query):
-	results = User.query.filter_by(nickname=query).all()
-	if results == []:
+	# nickname prefix and fuzzy matches first, then full text matches
+	matches = [id for id, nickname in nickname_index.complete(query, MAX_SEARCH_RESULTS)]
+	found = dict((user.id, user) for user in User.query.filter(User.id.in_(matches))) if matches else {}
+	results = [found[id] for id in matches if id in found]
+	results += [user for user in search_index.search_users(query, MAX_SEARCH_RESULTS) if user.id not in found]
+	results = results[:MAX_SEARCH_RESULTS]
+	posts = search_index.search_posts(query, MAX_SEARCH_RESULTS)
+	if results == [] and posts == []:
 		flash(gettext("No results found for '%(query)s'.", query=query))
 
 	return render_template('search_results.html',
 							query=query,
-							results=results)
\ No newline at end of file
+							results=results,
+							following=g.user.following_ids(user.id for user in results),
+							posts=posts)
+
+@main.route('/typeahead')
+@login_required
+def typeahead():
+	"""JSON nickname suggestions for the search box, served from memory."""
+	query = request.args.get('q', '').strip()
+	try:
+		limit = min(int(request.args.get('limit', current_app.config['TYPEAHEAD_RESULTS'])), MAX_SEARCH_RESULTS)
+	except ValueError:
+		limit = current_app.config['TYPEAHEAD_RESULTS']
+	if not query:
+		return jsonify(results=[])
+	return jsonify(results=[{'id': id, 'nickname': nickname, 'url': url_for('.user', nickname=nickname)}
+							for id, nickname in nickname_index.complete(query, limit)])
@@ -0,0 +1,43 @@
+#!flask/bin/python
+# yes/no checks asked as count() > 0 and as EXISTS, as a user's follow list
+# and a post's hearts grow, on a throwaway database
+import os
+import tempfile
+import timeit
+from datetime import datetime
+from app import create_app, db, presence
+from app.models import User, Post, UserPostHearts, followers
+
+SIZES = [10, 100, 1000, 10000, 100000]
+ROUNDS = 200
+
+workdir = tempfile.mkdtemp()
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+				  'WHOOSH_BASE': os.path.join(workdir, 'search'), 'TESTING': True, 'SECRET_KEY': 'bench'})
+app.app_context().push()
+db.create_all()
+db.session.execute(User.__table__.insert(), [{'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i} for i in range(max(SIZES) + 1)])
+db.session.execute(Post.__table__.insert(), [{'body': 'post', 'user_id': 1, 'timestamp': datetime.utcnow()}])
+db.session.commit()
+me = User.query.get(1)
+post = Post.query.get(1)
+stranger = User.query.get(max(SIZES) + 1)
+
+def measure(name, count, exists):
+	old = timeit.timeit(count, number=ROUNDS) * 1000000 / ROUNDS
+	new = timeit.timeit(exists, number=ROUNDS) * 1000000 / ROUNDS
+	print('%-14s %6d rows  count() %8.1fus  exists %6.1fus' % (name, size, old, new))
+
+done = 0
+for size in SIZES:
+	# follows and hearts by users 2 .. size + 1; the stranger is the last one
+	db.session.execute(followers.insert(), [{'follower_id': me.id, 'followed_id': i} for i in range(done + 2, size + 2)])
+	db.session.execute(UserPostHearts.__table__.insert(), [{'post_id': post.id, 'user_id': i} for i in range(done + 2, size + 2)])
+	db.session.commit()
+	done = size
+	measure('is_following', lambda: me.followed.filter(followers.c.followed_id == stranger.id).count() > 0,
+			lambda: me.is_following(stranger))
+	measure('with_heart', lambda: post.user_hearts.filter(UserPostHearts.post_id == post.id).count() > 0,
+			lambda: post.with_heart())
+presence.flush()
+db.drop_all()
@@ -0,0 +1,85 @@
+#!flask/bin/python
+# timeline reads and post writes from concurrent threads on a throwaway
+# SQLite database, with SQLite's defaults (rollback journal, full syncing,
+# a new connection per checkout) and with the tuned SQLITE_PRAGMAS and pool
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import User, Post
+
+USERS = 100
+POSTS = 5000
+READERS = 8
+WRITERS = 2
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+def setup(name, config):
+	workdir = tempfile.mkdtemp()
+	config.update({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, name + '.db'),
+				   'WHOOSH_BASE': os.path.join(workdir, 'search'),
+				   'TESTING': True, 'SECRET_KEY': 'bench', 'TIMELINE_ENABLED': False})
+	app = create_app(config)
+	with app.app_context():
+		db.create_all()
+		db.session.execute(User.__table__.insert(), [{'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i} for i in range(USERS)])
+		now = datetime.utcnow()
+		db.session.execute(Post.__table__.insert(), [{'body': 'post number %d' % i, 'user_id': i % USERS + 1,
+													  'timestamp': now - timedelta(minutes=i)} for i in range(POSTS)])
+		db.session.commit()
+		me = User.query.get(1)
+		for user in User.query.all():
+			me.follow(user)
+		db.session.commit()
+	return app
+
+def run(app, work, counts, deadline):
+	with app.app_context():
+		while time.time() < deadline:
+			start = time.time()
+			try:
+				work()
+				counts['done'] += 1
+				counts['latency'] = max(counts['latency'], time.time() - start)
+			except OperationalError:
+				db.session.rollback()
+				counts['failed'] += 1
+			finally:
+				db.session.remove()
+
+def read():
+	User.query.get(1).followed_posts().limit(20).all()
+
+def write():
+	user_id = int(time.time() * 1000) % USERS + 1
+	db.session.execute(Post.__table__.insert(), {'body': 'new post', 'user_id': user_id, 'timestamp': datetime.utcnow()})
+	db.session.execute(User.__table__.update().where(User.id == user_id), {'last_seen': datetime.utcnow()})
+	db.session.commit()
+
+def measure(name, config):
+	app = setup(name, config)
+	deadline = time.time() + SECONDS
+	threads = []
+	for work, count in [(read, READERS), (write, WRITERS)]:
+		for i in range(count):
+			counts = {'done': 0, 'failed': 0, 'latency': 0}
+			threads.append((work, counts, threading.Thread(target=run, args=(app, work, counts, deadline))))
+	for work, counts, thread in threads:
+		thread.start()
+	for work, counts, thread in threads:
+		thread.join()
+	for work in [read, write]:
+		done = sum(c['done'] for w, c, t in threads if w is work)
+		failed = sum(c['failed'] for w, c, t in threads if w is work)
+		latency = max(c['latency'] for w, c, t in threads if w is work)
+		print('%-8s %-5s %7.1f/s  %4d locked  worst %6.1fms' % (name, work.__name__, done / SECONDS, failed, latency * 1000))
+	with app.app_context():
+		db.drop_all()
+		db.engine.dispose()
+
+measure('default', {'SQLITE_PRAGMAS': {}, 'SQLALCHEMY_POOL_SIZE': None})
+measure('tuned', {})
@@ -0,0 +1,34 @@
+#!flask/bin/python
+# startup cost, measured in fresh interpreters: the framework imports every
+# process pays regardless, then importing the package, building the
+# application (what every script pays) and serving the first page (what a
+# new worker pays)
+import os
+import subprocess
+import sys
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+STEPS = ['frameworks', 'import app', 'create_app()', 'first request']
+
+TIMER = '''
+import time
+times = [time.time()]
+import flask, flask_sqlalchemy, flask_login, flask_babel
+times.append(time.time())
+import app
+times.append(time.time())
+application = app.create_app({'LOG_FILE': None})
+times.append(time.time())
+application.test_client().get('/login')
+times.append(time.time())
+print(' '.join(str(b - a) for a, b in zip(times, times[1:])))
+'''
+
+env = dict(os.environ)
+env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH', '')])
+rounds = [[float(t) for t in subprocess.check_output([sys.executable, '-W', 'ignore', '-c', TIMER], env=env,
+													 stderr=subprocess.DEVNULL).split()] for i in range(ROUNDS)]
+for i, name in enumerate(STEPS):
+	times = sorted(r[i] for r in rounds)
+	print('%-14s median %6.1fms  min %6.1fms' % (name, times[len(times) // 2] * 1000, times[0] * 1000))
@@ -0,0 +1,61 @@
+#!flask/bin/python
+# who to follow on a generated graph with a million follows: the numpy and
+# pure Python computations alone, then full and incremental refreshes
+# through the database on a throwaway copy
+import os
+import random
+import sys
+import tempfile
+import time
+from array import array
+from app import create_app, db
+from app import suggestions
+from app.models import User, followers
+
+USERS = 50000
+EDGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+CHANGED = 100
+K = 20
+
+random.seed(1)
+# a few popular users are followed by many: targets are drawn skewed
+edges = set()
+while len(edges) < EDGES:
+	follower = random.randint(1, USERS)
+	followed = min(int(random.paretovariate(1.2)), USERS) if random.random() < 0.3 else random.randint(1, USERS)
+	if follower != followed:
+		edges.add((follower, followed))
+edges = sorted(edges)
+sources = array('i', (follower for follower, followed in edges))
+targets = array('i', (followed for follower, followed in edges))
+user_ids = range(1, USERS + 1)
+
+def timed(name, function, *args):
+	start = time.time()
+	result = function(*args)
+	print('%-28s %6.1fs' % (name, time.time() - start))
+	return result
+
+if suggestions.numpy is not None:
+	expected = timed('numpy, all users', suggestions.compute_numpy, sources, targets, user_ids, K)
+sample = random.sample(user_ids, 2000)
+python = timed('pure Python, 2000 users', suggestions.compute_python, sources, targets, sample, K)
+if suggestions.numpy is not None:
+	assert all(python.get(id) == expected.get(id) for id in sample)
+
+workdir = tempfile.mkdtemp()
+app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+				  'WHOOSH_BASE': os.path.join(workdir, 'search'), 'TESTING': True, 'SECRET_KEY': 'bench'})
+with app.app_context():
+	db.create_all()
+	db.session.execute(User.__table__.insert(), [{'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i} for i in user_ids])
+	db.session.execute(followers.insert(), [{'follower_id': follower, 'followed_id': followed} for follower, followed in edges])
+	db.session.commit()
+	timed('refresh, all users', suggestions.refresh, True)
+	changed = [User.query.get(id) for id in random.sample(user_ids, CHANGED)]
+	for user in changed:
+		user.follow(User.query.get(random.randint(1, USERS)))
+	db.session.commit()
+	stale = User.query.filter_by(suggestions_stale=True).count()
+	timed('refresh, %d stale users' % stale, suggestions.refresh)
+	db.drop_all()
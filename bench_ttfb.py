@@ -0,0 +1,63 @@
+#!flask/bin/python
+# time to first byte and total time of the home timeline, rendered in one
+# piece and streamed, with and without gzip, on a throwaway database
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from app import create_app, db, compressor, presence
+from app.models import User, Post
+
+USERS = 200
+POSTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+ROUNDS = 20
+
+app = create_app()
+workdir = tempfile.mkdtemp()
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+app.config['WHOOSH_BASE'] = os.path.join(workdir, 'search')
+app.config['TESTING'] = True
+app.config['SECRET_KEY'] = app.config['SECRET_KEY'] or 'bench'
+app.app_context().push()
+db.create_all()
+db.session.execute(User.__table__.insert(), [{'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i} for i in range(USERS)])
+now = datetime.utcnow()
+db.session.execute(Post.__table__.insert(), [{'body': 'post number %d' % i, 'user_id': i % USERS + 1,
+											  'timestamp': now - timedelta(minutes=i)} for i in range(POSTS)])
+db.session.commit()
+me = User.query.get(1)
+for user in User.query.all():
+	me.follow(user)
+db.session.commit()
+
+client = app.test_client()
+with client.session_transaction() as session:
+	session['user_id'] = str(me.id)
+	session['_fresh'] = True
+
+def measure(stream, gzip):
+	app.config['STREAM_TEMPLATES'] = stream
+	compressor.enabled = gzip
+	first = total = size = 0
+	for i in range(ROUNDS):
+		start = time.time()
+		rv = client.get('/index', headers={'Accept-Encoding': 'gzip'})
+		chunks = iter(rv.response)
+		size = len(next(chunks))
+		first += time.time() - start
+		for chunk in chunks:
+			size += len(chunk)
+		rv.close()
+		total += time.time() - start
+	print('%-10s %-5s ttfb %6.1fms  total %6.1fms  %6d bytes' % ('streamed' if stream else 'buffered', 'gzip' if gzip else 'plain',
+																   first * 1000 / ROUNDS, total * 1000 / ROUNDS, size))
+
+# warm up the caches and the connection pool
+for i in range(ROUNDS):
+	client.get('/index', buffered=True)
+for stream in [False, True]:
+	for gzip in [False, True]:
+		measure(stream, gzip)
+presence.flush()
+db.drop_all()
@@ -0,0 +1,8 @@
+#!flask/bin/python
+from app import create_app, db
+from app.models import reconcile_counters
+# recompute the follower, followed, post and heart counters from scratch
+with create_app().app_context():
+	reconcile_counters()
+	db.session.commit()
+print('Counters reconciled')
@@ -0,0 +1,6 @@
+#!flask/bin/python
+from app import create_app, search_index
+# rebuild the full text search indexes of posts and users from the database
+with create_app().app_context():
+	search_index.reindex()
+print('Search indexes rebuilt')
@@ -0,0 +1,28 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+timeline = Table('timeline', post_meta,
+    Column('follower_id', Integer, primary_key=True, nullable=False),
+    Column('post_id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+    Index('ix_timeline_follower_timestamp', 'follower_id', 'timestamp'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].drop()
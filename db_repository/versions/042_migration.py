@@ -0,0 +1,51 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+    Column('heart_count', Integer, nullable=False, server_default='0'),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('follower_count', Integer, nullable=False, server_default='0'),
+    Column('followed_count', Integer, nullable=False, server_default='0'),
+    Column('post_count', Integer, nullable=False, server_default='0'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post'].columns['heart_count'].create()
+    post_meta.tables['user'].columns['follower_count'].create()
+    post_meta.tables['user'].columns['followed_count'].create()
+    post_meta.tables['user'].columns['post_count'].create()
+    # backfill the new counters from the existing rows
+    migrate_engine.execute('UPDATE post SET heart_count = (SELECT count(*) FROM user_post_hearts WHERE user_post_hearts.post_id = post.id)')
+    migrate_engine.execute('UPDATE user SET follower_count = (SELECT count(*) FROM followers WHERE followers.followed_id = user.id), '
+                           'followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = user.id), '
+                           'post_count = (SELECT count(*) FROM post WHERE post.user_id = user.id)')
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post'].columns['heart_count'].drop()
+    post_meta.tables['user'].columns['follower_count'].drop()
+    post_meta.tables['user'].columns['followed_count'].drop()
+    post_meta.tables['user'].columns['post_count'].drop()
@@ -0,0 +1,43 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+follower_notification = Table('follower_notification', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('recipient_id', Integer),
+    Column('follower_id', Integer),
+    Column('timestamp', DateTime),
+    Index('ix_follower_notification_recipient_id', 'recipient_id'),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('follower_count', Integer, nullable=False, server_default='0'),
+    Column('followed_count', Integer, nullable=False, server_default='0'),
+    Column('post_count', Integer, nullable=False, server_default='0'),
+    Column('notify_digest', Boolean(create_constraint=False), nullable=False, server_default='0'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['follower_notification'].create()
+    post_meta.tables['user'].columns['notify_digest'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['follower_notification'].drop()
+    post_meta.tables['user'].columns['notify_digest'].drop()
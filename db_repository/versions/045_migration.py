@@ -0,0 +1,80 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer),
+    Column('followed_id', Integer),
+    Index('ix_followers_follower_followed', 'follower_id', 'followed_id', unique=True),
+    Index('ix_followers_followed_follower', 'followed_id', 'follower_id'),
+)
+
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+    Column('heart_count', Integer, nullable=False, server_default='0'),
+)
+Index('ix_post_user_timestamp', post.c.user_id, post.c.timestamp.desc(), post.c.id.desc())
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('follower_count', Integer, nullable=False, server_default='0'),
+    Column('followed_count', Integer, nullable=False, server_default='0'),
+)
+
+user_post_hearts = Table('user_post_hearts', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+    Column('post_id', Integer),
+    Index('ix_user_post_hearts_user_post', 'user_id', 'post_id', unique=True),
+)
+
+
+def remove_duplicates(migrate_engine):
+    # the unique indexes can not be built over repeated rows: keep one row
+    # of each and fix the counters of the users and posts involved
+    pairs = select([followers.c.follower_id, followers.c.followed_id]) \
+        .group_by(followers.c.follower_id, followers.c.followed_id) \
+        .having(func.count() > 1)
+    for follower_id, followed_id in migrate_engine.execute(pairs).fetchall():
+        migrate_engine.execute(followers.delete()
+            .where(followers.c.follower_id == follower_id)
+            .where(followers.c.followed_id == followed_id))
+        migrate_engine.execute(followers.insert(), follower_id=follower_id, followed_id=followed_id)
+        for column, key in [(user.c.followed_count, followers.c.follower_id), (user.c.follower_count, followers.c.followed_id)]:
+            for user_id in [follower_id, followed_id]:
+                count = select([func.count()]).where(key == user_id).as_scalar()
+                migrate_engine.execute(user.update().where(user.c.id == user_id).values({column: count}))
+
+    keep = select([func.min(user_post_hearts.c.id)]) \
+        .group_by(user_post_hearts.c.user_id, user_post_hearts.c.post_id)
+    repeated = select([user_post_hearts.c.post_id]).distinct().where(~user_post_hearts.c.id.in_(keep))
+    post_ids = [post_id for post_id, in migrate_engine.execute(repeated).fetchall()]
+    if post_ids:
+        migrate_engine.execute(user_post_hearts.delete().where(~user_post_hearts.c.id.in_(keep)))
+        count = select([func.count()]).where(user_post_hearts.c.post_id == post.c.id).as_scalar()
+        migrate_engine.execute(post.update().where(post.c.id.in_(post_ids)).values(heart_count=count))
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    remove_duplicates(migrate_engine)
+    for index in followers.indexes | post.indexes | user_post_hearts.indexes:
+        index.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for index in followers.indexes | post.indexes | user_post_hearts.indexes:
+        index.drop()
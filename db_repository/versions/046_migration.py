@@ -0,0 +1,74 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+posthearts = Table('posthearts', pre_meta,
+    Column('user_id', Integer),
+    Column('post_id', Integer),
+    Column('timestamp', DateTime),
+)
+
+user_post_hearts = Table('user_post_hearts', pre_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+    Column('post_id', Integer),
+)
+Index('ix_user_post_hearts_user_post', user_post_hearts.c.user_id, user_post_hearts.c.post_id, unique=True)
+
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('heart_count', Integer, nullable=False, server_default='0'),
+)
+
+new_user_post_hearts = Table('user_post_hearts', post_meta,
+    Column('post_id', Integer, primary_key=True, nullable=False),
+    Column('user_id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+)
+Index('ix_user_post_hearts_user_post', new_user_post_hearts.c.user_id, new_user_post_hearts.c.post_id)
+
+
+def replace(migrate_engine, old, new):
+    # SQLite can not change a primary key in place: the new table is built
+    # under a temporary name, filled, and renamed once the old one is gone.
+    # The indexes keep their names, so the old ones go first
+    for index in old.indexes:
+        index.drop()
+    table = new.tometadata(MetaData(bind=migrate_engine), name='new_' + new.name)
+    table.create()
+    columns = [column.name for column in new.columns if column.name in old.c]
+    migrate_engine.execute(table.insert().from_select(columns, select([old.c[name] for name in columns])))
+    old.drop()
+    table.rename(new.name)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    replace(migrate_engine, user_post_hearts, new_user_post_hearts)
+    # posthearts was never written by the application, but whatever it
+    # holds moves over rather than being lost with the table
+    hearts = new_user_post_hearts
+    moved = select([posthearts.c.post_id, posthearts.c.user_id, func.min(posthearts.c.timestamp)]) \
+        .where(posthearts.c.post_id != None).where(posthearts.c.user_id != None) \
+        .where(~exists().where(hearts.c.post_id == posthearts.c.post_id).where(hearts.c.user_id == posthearts.c.user_id)) \
+        .group_by(posthearts.c.post_id, posthearts.c.user_id)
+    if migrate_engine.execute(moved.limit(1)).first() is not None:
+        migrate_engine.execute(hearts.insert().from_select(['post_id', 'user_id', 'timestamp'], moved))
+        migrate_engine.execute(post.update().values(
+            heart_count=select([func.count()]).where(hearts.c.post_id == post.c.id).as_scalar()))
+    posthearts.drop()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    posthearts.create()
+    replace(migrate_engine, new_user_post_hearts, user_post_hearts)
@@ -0,0 +1,45 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+suggestion = Table('suggestion', post_meta,
+    Column('user_id', Integer, primary_key=True, nullable=False),
+    Column('rank', Integer, primary_key=True, nullable=False, autoincrement=False),
+    Column('suggested_id', Integer, nullable=False),
+    Column('score', Integer, nullable=False),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('email_hash', String(length=32)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('follower_count', Integer, nullable=False, server_default='0'),
+    Column('followed_count', Integer, nullable=False, server_default='0'),
+    Column('post_count', Integer, nullable=False, server_default='0'),
+    Column('notify_digest', Boolean, nullable=False, server_default='0'),
+    Column('suggestions_stale', Boolean(create_constraint=False), nullable=False, server_default='1'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['suggestion'].create()
+    # every existing user is stale, the first db_suggestions.py run covers them all
+    post_meta.tables['user'].columns['suggestions_stale'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['suggestion'].drop()
+    post_meta.tables['user'].columns['suggestions_stale'].drop()
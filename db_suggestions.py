@@ -0,0 +1,11 @@
+#!flask/bin/python
+import sys
+import time
+from app import create_app
+from app.suggestions import refresh, numpy
+# recompute the who to follow suggestions of the users whose follows changed,
+# e.g. every few minutes from cron; 'all' recomputes everybody's
+start = time.time()
+with create_app().app_context():
+	count = refresh(all_users=sys.argv[1:] == ['all'])
+print('Refreshed suggestions for %d users in %.1fs (%s)' % (count, time.time() - start, 'numpy' if numpy is not None else 'pure Python'))
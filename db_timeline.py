@@ -0,0 +1,13 @@
+#!flask/bin/python
+from app import create_app, db
+from app.models import User
+# backfill the materialized home timelines, e.g. before turning on TIMELINE_ENABLED
+count = 0
+with create_app().app_context():
+	for user in User.query.all():
+		user.rebuild_timeline()
+		count += 1
+		if count % 100 == 0:
+			db.session.commit()
+	db.session.commit()
+print('Rebuilt timelines for ' + str(count) + ' users')
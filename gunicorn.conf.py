@@ -0,0 +1,30 @@
+# gunicorn settings for serving wsgi:app in production, see the README.
+# Every value can be overridden from the environment.
+import multiprocessing
+import os
+
+bind = os.environ.get('MICROBLOG_BIND', '0.0.0.0:8000')
+
+# one process per core (twice over, plus one, to cover requests blocked on
+# the database or SMTP) with a few threads each
+workers = int(os.environ.get('MICROBLOG_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('MICROBLOG_THREADS', 4))
+
+# the application is imported once in the master and forked into the workers
+preload_app = True
+
+# recycle the workers now and then, staggered so they do not all restart at once
+max_requests = 1000
+max_requests_jitter = 100
+
+timeout = 30
+graceful_timeout = 30
+
+def post_fork(server, worker):
+	# a worker must not reuse database connections opened in the master,
+	# so every worker starts with an empty pool of its own
+	from wsgi import app
+	from app import db
+	with app.app_context():
+		db.engine.dispose()
@@ -1,3 +1,4 @@
- #!flask/bin/python
-from app import app
+#!flask/bin/python
+from app import create_app
+app = create_app()
 app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
@@ -0,0 +1,8 @@
+#!flask/bin/python
+from app import create_app
+from app.emails import send_digests
+from config import SITE_URL
+# run periodically (e.g. hourly from cron) to mail the follower digests
+with create_app().test_request_context(base_url=SITE_URL):
+	sent = send_digests()
+print('Sent ' + str(sent) + ' digests')
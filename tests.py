@@ -1,23 +1,128 @@
 #!flask/bin/python
 import os
+import re
+import gzip
+import json
+import shutil
+import tempfile
+import threading
 import unittest
+import asyncore
+import smtpd
+from hashlib import md5
 
 from config import basedir
-from app import app, db
+from app import create_app, db, mail, mailer, presence, users, search_index, nickname_index, fragments, assets, graph
+from app.emails import send_digests
+from app.momentjs import momentjs
+from app.mailer import MailDispatcher
+from app.lazy import LazyExtension
+from flask import g
+from flask_mail import Message
 from datetime import datetime, timedelta
-from app.models import User, Post
+from app.models import User, Post, UserPostHearts, FollowerNotification, Suggestion, followers, timeline, reconcile_counters
+from app.pagination import encode_cursor
+from app import suggestions
+from sqlalchemy import event
+
+app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'SECRET_KEY': 'test',
+				  'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'test.db')})
+
+class QueryCounter(object):
+	"""Counts the SQL statements issued inside a with block."""
+	def __enter__(self):
+		self.count = 0
+		event.listen(db.engine, 'before_cursor_execute', self.callback)
+		return self
+
+	def __exit__(self, *args):
+		event.remove(db.engine, 'before_cursor_execute', self.callback)
+
+	def callback(self, *args):
+		self.count += 1
+
+def query_plan(query):
+	"""SQLite's EXPLAIN QUERY PLAN for a query, one line per step."""
+	statement = query.statement.compile(db.engine)
+	cursor = db.session.connection().connection.cursor()
+	cursor.execute('EXPLAIN QUERY PLAN ' + str(statement), [statement.params[name] for name in statement.positiontup])
+	return [row[-1] for row in cursor.fetchall()]
+
+def executed_plans(run):
+	"""query_plan() of every SELECT that run() executes."""
+	statements = []
+	def record(conn, cursor, statement, parameters, context, executemany):
+		if statement.lstrip().upper().startswith('SELECT'):
+			statements.append((statement, parameters))
+	event.listen(db.engine, 'before_cursor_execute', record)
+	try:
+		run()
+	finally:
+		event.remove(db.engine, 'before_cursor_execute', record)
+	cursor = db.session.connection().connection.cursor()
+	plans = []
+	for statement, parameters in statements:
+		cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+		plans.append([row[-1] for row in cursor.fetchall()])
+	return plans
+
+class StubSMTPServer(smtpd.SMTPServer):
+	"""Local SMTP server that keeps what it receives in memory."""
+	def __init__(self):
+		self.map = {}
+		smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None, map=self.map, decode_data=False)
+		self.port = self.socket.getsockname()[1]
+		self.messages = []
+		self.connections = 0
+		self.running = True
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.start()
+
+	def serve(self):
+		while self.running:
+			asyncore.loop(timeout=0.05, count=1, map=self.map)
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		asyncore.close_all(map=self.map)
+
+	def handle_accepted(self, conn, addr):
+		self.connections += 1
+		smtpd.SMTPServer.handle_accepted(self, conn, addr)
+
+	def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+		self.messages.append((mailfrom, rcpttos, data))
 
 class TestCase(unittest.TestCase):
 	def setUp(self):
 		app.config['TESTING'] = True
 		app.config['WTF_CSRF_ENABLED'] = False
+		app.config['SECRET_KEY'] = 'test'
 		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+		app.config['WHOOSH_BASE'] = tempfile.mkdtemp()
 		self.app = app.test_client()
+		self.context = app.app_context()
+		self.context.push()
 		db.create_all()
 
 	def tearDown(self):
+		presence.pending.clear()
+		users.snapshots.clear()
+		users.nicknames.clear()
+		search_index.indexes.clear()
+		nickname_index.clear()
+		fragments.clear()
+		graph.clear()
+		shutil.rmtree(app.config['WHOOSH_BASE'])
 		db.session.remove()
 		db.drop_all()
+		self.context.pop()
+
+	def login(self, user):
+		with self.app.session_transaction() as session:
+			session['user_id'] = user.get_id()
+			session['_fresh'] = True
 
 	def test_avatar(self):
 		u = User(nickname='john', email='john@example.com')
@@ -25,6 +130,21 @@ class TestCase(unittest.TestCase):
 		expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
 		assert avatar[0:len(expected)] == expected
 
+	def test_email_hash(self):
+		u = User(nickname='john', email='john@example.com')
+		assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+		u.email = 'susan@example.com'
+		assert u.email_hash == md5(b'susan@example.com').hexdigest()
+		assert u.avatar(64) == 'http://www.gravatar.com/avatar/%s?d=mm&s=64' % u.email_hash
+		# cached users come back with their hash and without rehashing
+		db.session.add(u)
+		db.session.commit()
+		users.remember(u)
+		db.session.expunge_all()
+		cached = users.get(u.id)
+		assert cached.email_hash == md5(b'susan@example.com').hexdigest()
+		assert not db.session.dirty
+
 	def test_make_unique_nickname(self):
 		u = User(nickname='john', email='john@example.com')
 		db.session.add(u)
@@ -126,5 +246,915 @@ class TestCase(unittest.TestCase):
 		assert f3 == [p4, p3]
 		assert f4 == [p4]
 
+	def test_timeline(self):
+		app.config['TIMELINE_ENABLED'] = True
+		app.config['TIMELINE_DEPTH'] = 2
+		try:
+			u1 = User(nickname='john', email='john@example.com')
+			u2 = User(nickname='susan', email='susan@example.com')
+			db.session.add(u1)
+			db.session.add(u2)
+			db.session.commit()
+			u1.follow(u1)
+			u2.follow(u2)
+			db.session.commit()
+
+			# posts are pushed to the followers' timelines as they are made
+			utcnow = datetime.utcnow()
+			p1 = Post(body="post from john", author=u1, timestamp=utcnow + timedelta(seconds=1))
+			p2 = Post(body="post from susan", author=u2, timestamp=utcnow + timedelta(seconds=2))
+			for p in [p1, p2]:
+				db.session.add(p)
+				p.fan_out()
+			db.session.commit()
+			assert u1.followed_posts().all() == [p1]
+
+			# following someone rebuilds the timeline from scratch
+			u1.follow(u2)
+			db.session.flush()
+			u1.rebuild_timeline()
+			db.session.commit()
+			assert u1.followed_posts().all() == [p2, p1]
+			page = u1.followed_posts().paginate_keyset(per_page=1)
+			assert page.items == [p2] and page.has_next
+			assert u1.followed_posts().paginate_keyset(before=page.next_cursor, per_page=1).items == [p1]
+
+			# timelines are trimmed back to TIMELINE_DEPTH
+			p3 = Post(body="another post from susan", author=u2, timestamp=utcnow + timedelta(seconds=3))
+			db.session.add(p3)
+			p3.fan_out()
+			db.session.commit()
+			assert u1.followed_posts().all() == [p3, p2]
+			assert u2.followed_posts().all() == [p3, p2]
+
+			u1.unfollow(u2)
+			db.session.flush()
+			u1.rebuild_timeline()
+			db.session.commit()
+			assert u1.followed_posts().all() == [p1]
+		finally:
+			app.config['TIMELINE_ENABLED'] = False
+			app.config['TIMELINE_DEPTH'] = 800
+
+	def test_timeline_trim_cost(self):
+		# one post trims every follower's full timeline; the work must grow
+		# with the depth, not with its square
+		author = User(nickname='john', email='john@example.com')
+		audience = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(5)]
+		db.session.add_all([author] + audience)
+		db.session.commit()
+		db.session.execute(followers.insert(), [{'follower_id': u.id, 'followed_id': author.id} for u in audience])
+		db.session.commit()
+		utcnow = datetime.utcnow()
+		steps = []
+		for depth in [100, 200]:
+			app.config['TIMELINE_DEPTH'] = depth
+			try:
+				db.session.execute(timeline.delete())
+				db.session.execute(timeline.insert(), [{'follower_id': u.id, 'post_id': -i, 'timestamp': utcnow - timedelta(seconds=i)}
+													   for u in audience for i in range(1, depth + 1)])
+				post = Post(body='post', author=author, timestamp=utcnow)
+				db.session.add(post)
+				db.session.flush()
+				count = [0]
+				def step():
+					count[0] += 1
+				connection = db.session.connection().connection
+				connection.set_progress_handler(step, 100)
+				try:
+					post.fan_out()
+				finally:
+					connection.set_progress_handler(None, 100)
+				db.session.commit()
+				steps.append(count[0])
+			finally:
+				app.config['TIMELINE_DEPTH'] = 800
+			assert db.session.query(timeline).count() == len(audience) * depth
+		assert steps[1] < 3 * steps[0], steps
+
+	def test_keyset_pagination(self):
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		utcnow = datetime.utcnow()
+		posts = [Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i)) for i in range(7)]
+		# two posts sharing a timestamp are told apart by id
+		posts.append(Post(body='post 7', author=u, timestamp=posts[6].timestamp))
+		db.session.add_all(posts)
+		db.session.commit()
+		newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+		page1 = u.posts.paginate_keyset(per_page=3)
+		assert page1.items == newest_first[0:3]
+		assert not page1.has_prev and page1.has_next
+		page2 = u.posts.paginate_keyset(before=page1.next_cursor, per_page=3)
+		assert page2.items == newest_first[3:6]
+		assert page2.has_prev and page2.has_next
+		page3 = u.posts.paginate_keyset(before=page2.next_cursor, per_page=3)
+		assert page3.items == newest_first[6:8]
+		assert page3.has_prev and not page3.has_next
+
+		# and back again
+		back = u.posts.paginate_keyset(after=page3.prev_cursor, per_page=3)
+		assert back.items == page2.items
+		assert back.has_prev and back.has_next
+		back = u.posts.paginate_keyset(after=back.prev_cursor, per_page=3)
+		assert back.items == page1.items
+		assert not back.has_prev
+
+		assert u.posts.paginate_keyset(before='garbage', per_page=3, error_out=False).items == page1.items
+
+	def test_load_hearts(self):
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		utcnow = datetime.utcnow()
+		posts = [Post(body='post %d' % i, author=u1, timestamp=utcnow + timedelta(seconds=i)) for i in range(20)]
+		db.session.add_all(posts)
+		db.session.commit()
+		db.session.add(UserPostHearts(user_id=u1.id, post_id=posts[0].id))
+		db.session.add(UserPostHearts(user_id=u2.id, post_id=posts[0].id))
+		db.session.add(UserPostHearts(user_id=u2.id, post_id=posts[1].id))
+		db.session.commit()
+
+		Post.load_hearts(posts, u1)
+		assert (posts[0].heart_count, posts[0].hearted) == (2, True)
+		assert (posts[1].heart_count, posts[1].hearted) == (1, False)
+		assert (posts[2].heart_count, posts[2].hearted) == (0, False)
+
+		# the cost of a page does not depend on its size
+		u2.id
+		for size in [1, 5, 20]:
+			with QueryCounter() as queries:
+				Post.load_hearts(posts[:size], u2)
+			assert queries.count == 1
+
+	def test_hearts(self):
+		u = User(nickname='john', email='john@example.com')
+		p = Post(body='post', author=u, timestamp=datetime.utcnow())
+		db.session.add_all([u, p])
+		db.session.commit()
+		uid, pid = u.id, p.id
+		self.login(u)
+		assert not p.with_heart() and not u.did_heart(p)
+
+		# hearting twice keeps one heart
+		for i in range(2):
+			rv = self.app.get('/heart_post/%d' % pid)
+			assert rv.status_code == 302
+		db.session.expire_all()
+		p, u = Post.query.get(pid), User.query.get(uid)
+		assert p.with_heart() and u.did_heart(p) and p.heart_count == 1
+		assert UserPostHearts.query.get((pid, uid)).timestamp is not None
+		assert self.app.get('/heart_post/%d' % (pid + 1)).status_code == 404
+
+		for i in range(2):
+			rv = self.app.get('/unheart_post/%d' % pid)
+			assert rv.status_code == 302
+		db.session.expire_all()
+		p, u = Post.query.get(pid), User.query.get(uid)
+		assert not p.with_heart() and not u.did_heart(p) and p.heart_count == 0
+
+		# two unhearts racing: the first one's delete commits after the
+		# second request has read the heart, so the second deletes nothing
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add(u2)
+		db.session.commit()
+		db.session.add_all([UserPostHearts(post_id=pid, user_id=uid), UserPostHearts(post_id=pid, user_id=u2.id)])
+		db.session.commit()
+		heart = UserPostHearts.query.get((pid, uid))
+		db.engine.execute(UserPostHearts.__table__.delete().where(UserPostHearts.__table__.c.user_id == uid))
+		db.engine.execute(Post.__table__.update().values(heart_count=Post.__table__.c.heart_count - 1))
+		rv = self.app.get('/unheart_post/%d' % pid)
+		assert rv.status_code == 302
+		db.session.expire_all()
+		assert Post.query.get(pid).heart_count == 1
+
+		# the same for deleting the post itself
+		p = Post.query.get(pid)
+		assert p.author.id == uid
+		db.engine.execute(Post.__table__.delete().where(Post.__table__.c.id == pid))
+		db.engine.execute(User.__table__.update().values(post_count=User.__table__.c.post_count - 1))
+		rv = self.app.get('/delete/%d' % pid)
+		assert rv.status_code == 302
+		db.session.expire_all()
+		assert User.query.get(uid).post_count == 0
+
+	def test_follow_race(self):
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+		db.session.add(u1.follow(u2))
+		db.session.commit()
+		id1, id2 = u1.id, u2.id
+		self.login(u1)
+		# a double click: the second request checked before the first committed
+		is_following = User.is_following
+		try:
+			User.is_following = lambda self, user: False
+			rv = self.app.get('/follow/susan')
+			assert rv.status_code == 302
+			db.session.expire_all()
+			assert User.query.get(id1).followed_count == 1 and User.query.get(id2).follower_count == 1
+			User.is_following = is_following
+			self.app.get('/unfollow/susan')
+			User.is_following = lambda self, user: True
+			rv = self.app.get('/unfollow/susan')
+			assert rv.status_code == 302
+			db.session.expire_all()
+			assert User.query.get(id1).followed_count == 0 and User.query.get(id2).follower_count == 0
+		finally:
+			User.is_following = is_following
+
+	def test_existence_checks(self):
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		u3 = User(nickname='mary', email='mary@example.com')
+		db.session.add_all([u1, u2, u3])
+		db.session.commit()
+		posts = [Post(body='post %d' % i, author=u2, timestamp=datetime.utcnow()) for i in range(3)]
+		db.session.add_all(posts)
+		u1.follow(u2)
+		db.session.commit()
+		db.session.add_all([UserPostHearts(user_id=u1.id, post_id=posts[0].id), UserPostHearts(user_id=u3.id, post_id=posts[0].id),
+							UserPostHearts(user_id=u1.id, post_id=posts[2].id)])
+		db.session.commit()
+
+		statements = []
+		def record(conn, cursor, statement, *args):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			assert u1.is_following(u2) and not u1.is_following(u3) and not u2.is_following(u1)
+			assert u1.did_heart(posts[0]) and not u1.did_heart(posts[1]) and not u2.did_heart(posts[0])
+			assert posts[0].with_heart() and not posts[1].with_heart()
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+		# one EXISTS per check, besides reloading the expired objects
+		assert len([statement for statement in statements if 'EXISTS' in statement]) == 8
+		assert not any('count(' in statement for statement in statements)
+
+		# the batch forms answer for many ids in one query
+		post_ids = [post.id for post in posts]
+		with QueryCounter() as queries:
+			assert u1.following_ids([u1.id, u2.id, u3.id]) == set([u2.id])
+			assert UserPostHearts.hearted_by(u1.id, post_ids) == set([post_ids[0], post_ids[2]])
+			assert u1.following_ids([]) == set() and UserPostHearts.hearted_by(u1.id, []) == set()
+		assert queries.count == 2
+
+		# search results mark the users already followed
+		self.login(u1)
+		rv = self.app.get('/search_results/susan')
+		assert rv.status_code == 200 and b'susan </b><small class="text-muted">following' in rv.data
+		rv = self.app.get('/search_results/mary')
+		assert rv.status_code == 200 and b'mary </b>' in rv.data and b'following' not in rv.data
+
+	def test_follow_graph(self):
+		people = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(6)]
+		db.session.add_all(people)
+		db.session.commit()
+		ids = [u.id for u in people]
+		me, star = people[0], people[5]
+		for u in people[1:4]:
+			me.follow(u)
+			u.follow(star)
+		me.follow(people[4])
+		db.session.commit()
+
+		assert list(graph.followed_ids(ids[0])) == ids[1:5]
+		assert list(graph.follower_ids(ids[5])) == ids[1:4]
+		assert list(graph.followed_by_followed(ids[0], ids[5])) == ids[1:4]
+		# cached, and many pairs are answered at once
+		with QueryCounter() as queries:
+			assert graph.is_following(ids[0], ids[1]) and not graph.is_following(ids[0], ids[5])
+			assert list(graph.followed_by_followed(ids[0], ids[5])) == ids[1:4]
+		assert queries.count == 0
+		with QueryCounter() as queries:
+			assert graph.are_following([(ids[1], ids[5]), (ids[4], ids[5]), (ids[2], ids[0])]) == [True, False, False]
+		assert queries.count == 1
+
+		# follows update the cached arrays when they commit, not before
+		me, star = User.query.get(ids[0]), User.query.get(ids[5])
+		me.unfollow(User.query.get(ids[1]))
+		User.query.get(ids[4]).follow(star)
+		assert list(graph.followed_by_followed(ids[0], ids[5])) == ids[1:4]
+		db.session.rollback()
+		assert list(graph.followed_by_followed(ids[0], ids[5])) == ids[1:4]
+		me, star = User.query.get(ids[0]), User.query.get(ids[5])
+		me.unfollow(User.query.get(ids[1]))
+		User.query.get(ids[4]).follow(star)
+		db.session.commit()
+		with QueryCounter() as queries:
+			assert list(graph.followed_ids(ids[0])) == ids[2:5]
+			assert list(graph.followed_by_followed(ids[0], ids[5])) == ids[2:5]
+		assert queries.count == 0
+
+		# the profile names the people you follow who follow the user
+		self.login(me)
+		rv = self.app.get('/user/user5', buffered=True)
+		assert b'Followed by' in rv.data and b'>user2</a>' in rv.data and b'>user1</a>' not in rv.data
+		assert b'Follow</a>' in rv.data and b'Unfollow' not in rv.data
+		rv = self.app.get('/user/user2', buffered=True)
+		assert b'Followed by' not in rv.data and b'Unfollow' in rv.data
+		# a follow committed by another process shows on the button at once
+		db.session.execute(followers.insert().values(follower_id=ids[0], followed_id=ids[5]))
+		db.session.commit()
+		rv = self.app.get('/user/user5', buffered=True)
+		assert b'Unfollow' in rv.data
+
+	def test_suggestions(self):
+		people = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(7)]
+		db.session.add_all(people)
+		db.session.commit()
+		ids = [u.id for u in people]
+		# user0 follows 1 and 2; 1 and 2 both follow 4, 2 also follows 3 and 5
+		for a, b in [(0, 1), (0, 2), (1, 4), (2, 4), (2, 3), (2, 5), (2, 0), (0, 0), (6, 0)]:
+			people[a].follow(people[b])
+		db.session.commit()
+
+		sources, targets = suggestions.load_edges()
+		expected = {ids[0]: [(ids[4], 2), (ids[3], 1), (ids[5], 1)], ids[2]: [(ids[1], 1)], ids[6]: [(ids[1], 1), (ids[2], 1)]}
+		assert suggestions.compute_python(sources, targets, ids, 5) == expected
+		assert suggestions.compute(sources, targets, ids, 5) == expected
+		assert suggestions.compute(sources, targets, ids, 2)[ids[0]] == [(ids[4], 2), (ids[3], 1)]
+
+		assert suggestions.refresh() == 7
+		assert User.query.filter_by(suggestions_stale=True).count() == 0
+		assert [u.nickname for u in Suggestion.for_user(ids[0], 2)] == ['user4', 'user3']
+		assert suggestions.refresh() == 0
+
+		# a follow marks the follower, and the run refreshes their followers too
+		User.query.get(ids[0]).follow(User.query.get(ids[4]))
+		db.session.commit()
+		assert [id for id, in db.session.query(User.id).filter_by(suggestions_stale=True)] == [ids[0]]
+		assert suggestions.refresh() == 3
+		assert [u.nickname for u in Suggestion.for_user(ids[0], 5)] == ['user3', 'user5']
+
+		# a failed run, or a follow made while it ran, leaves the users marked
+		compute = suggestions.compute
+		User.query.get(ids[0]).follow(User.query.get(ids[3]))
+		db.session.commit()
+		def failing(*args):
+			raise MemoryError
+		suggestions.compute = failing
+		try:
+			self.assertRaises(MemoryError, suggestions.refresh)
+		finally:
+			db.session.rollback()
+			suggestions.compute = compute
+		assert [id for id, in db.session.query(User.id).filter_by(suggestions_stale=True)] == [ids[0]]
+		def following(*args):
+			User.query.get(ids[0]).unfollow(User.query.get(ids[3]))
+			db.session.commit()
+			return compute(*args)
+		suggestions.compute = following
+		try:
+			assert suggestions.refresh() == 3
+		finally:
+			suggestions.compute = compute
+		assert [id for id, in db.session.query(User.id).filter_by(suggestions_stale=True)] == [ids[0]]
+		assert suggestions.refresh() == 3
+		assert User.query.filter_by(suggestions_stale=True).count() == 0
+
+		# the home page reads them, leaving out users followed since
+		User.query.get(ids[0]).follow(User.query.get(ids[5]))
+		db.session.commit()
+		self.login(User.query.get(ids[0]))
+		rv = self.app.get('/index', buffered=True)
+		assert b'Who to follow' in rv.data and b'>user3</a>' in rv.data and b'>user5</a>' not in rv.data
+		rv = self.app.get('/user/user3', buffered=True)
+		assert b'Who to follow' not in rv.data
+
+	def test_counters(self):
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+		u1.follow(u1)
+		u1.follow(u2)
+		u2.follow(u2)
+		p = Post(body='post from susan', author=u2, timestamp=datetime.utcnow())
+		db.session.add(p)
+		db.session.commit()
+		db.session.add(UserPostHearts(user_id=u1.id, post_id=p.id))
+		db.session.commit()
+		assert (u1.follower_count, u1.followed_count, u1.post_count) == (1, 2, 0)
+		assert (u2.follower_count, u2.followed_count, u2.post_count) == (2, 1, 1)
+		assert p.heart_count == 1
+
+		u1.unfollow(u2)
+		db.session.delete(p)
+		db.session.commit()
+		assert (u1.followed_count, u2.follower_count, u2.post_count) == (1, 1, 0)
+
+		# drifted counters are put right by reconcile_counters()
+		u1.follower_count = 7
+		db.session.commit()
+		reconcile_counters()
+		db.session.commit()
+		assert (u1.follower_count, u1.followed_count) == (1, 1)
+
+	def test_eager_authors(self):
+		viewer = User(nickname='viewer', email='viewer@example.com')
+		authors = [User(nickname='author%d' % i, email='author%d@example.com' % i) for i in range(5)]
+		db.session.add_all([viewer] + authors)
+		db.session.commit()
+		for user in [viewer] + authors:
+			viewer.follow(user)
+		db.session.commit()
+		self.login(viewer)
+
+		def render(url):
+			fragments.clear()
+			with QueryCounter() as queries:
+				rv = self.app.get(url, buffered=True)
+			assert rv.status_code == 200
+			return queries.count
+
+		# a page of posts by one author costs the same as a page by five
+		render('/user/author0')	# loads the follow lists
+		utcnow = datetime.utcnow()
+		db.session.add_all([Post(body='post %d' % i, author=authors[0], timestamp=utcnow + timedelta(seconds=i)) for i in range(5)])
+		db.session.commit()
+		render('/index')
+		render('/user/author4')
+		one_author = render('/index'), render('/user/author0')
+		db.session.add_all([Post(body='post by %d' % i, author=author, timestamp=utcnow + timedelta(seconds=10 + i)) for i, author in enumerate(authors)])
+		db.session.commit()
+		assert render('/index') == one_author[0]
+		assert render('/user/author4') == one_author[1]
+
+	def test_presence(self):
+		u1 = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+		self.login(u1)
+		self.app.get('/user/john', buffered=True)
+		u1 = User.query.filter_by(nickname='john').first()
+		assert u1.last_seen is None
+		seen = presence.last_seen(u1)
+		assert seen is not None
+		presence.touch(User.query.filter_by(nickname='susan').first().id)
+
+		# both users are written with one statement
+		with QueryCounter() as queries:
+			assert presence.flush() == 2
+		assert queries.count == 1
+		assert u1.last_seen == seen
+		assert User.query.filter_by(nickname='susan').first().last_seen is not None
+		assert presence.flush() == 0
+
+	def test_user_resolver(self):
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		db.session.commit()
+		with app.test_request_context():
+			assert users.by_nickname('john').id == u.id
+			with QueryCounter() as queries:
+				assert users.by_nickname('john') is u
+				assert users.get(u.id) is u
+			assert queries.count == 0
+			assert users.by_nickname('susan') is None
+
+		# a new request is answered from the cross-request cache
+		db.session.remove()
+		with app.test_request_context():
+			with QueryCounter() as queries:
+				john = users.by_nickname('john')
+				assert john.email == 'john@example.com'
+			assert queries.count == 0
+
+			# renames and counter changes are picked up
+			john.nickname = 'johnny'
+			db.session.commit()
+			assert users.by_nickname('john') is None
+			assert users.by_nickname('johnny').id == john.id
+			john.follow(john)
+			db.session.commit()
+		db.session.remove()
+		with app.test_request_context():
+			assert users.by_nickname('johnny').follower_count == 1
+
+	def test_search(self):
+		u1 = User(nickname='john', email='john@example.com', about_me='I like walking')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		utcnow = datetime.utcnow()
+		p1 = Post(body='running in the rain', author=u1, timestamp=utcnow)
+		p2 = Post(body='the rain in spain', author=u2, timestamp=utcnow)
+		p3 = Post(body='nothing to see here', author=u2, timestamp=utcnow)
+		db.session.add_all([p1, p2, p3])
+		db.session.commit()
+
+		assert search_index.search_posts('rain') in ([p1, p2], [p2, p1])
+		assert search_index.search_posts('running') == [p1]
+		assert search_index.search_users('susan') == [u2]
+		assert search_index.search_users('walks') == [u1]
+		assert len(search_index.search_posts('rain', limit=1)) == 1
+
+		# edits and deletes are picked up on commit
+		p3.body = 'spain again'
+		db.session.delete(p1)
+		db.session.commit()
+		assert search_index.search_posts('rain') == [p2]
+		assert search_index.search_posts('spain') in ([p2, p3], [p3, p2])
+
+		# and the index can be rebuilt from scratch
+		shutil.rmtree(app.config['WHOOSH_BASE'])
+		search_index.indexes.clear()
+		nickname_index.clear()
+		fragments.clear()
+		search_index.reindex()
+		assert search_index.search_posts('spain') in ([p2, p3], [p3, p2])
+		assert search_index.search_users('john') == [u1]
+
+	def test_typeahead(self):
+		for nickname in ['john', 'johnny', 'jonathan', 'susan', 'mary']:
+			db.session.add(User(nickname=nickname, email=nickname + '@example.com'))
+		db.session.commit()
+		names = lambda query, limit=10: [nickname for id, nickname in nickname_index.complete(query, limit)]
+		assert names('jo') == ['john', 'johnny', 'jonathan']
+		assert names('JOHN') == ['john', 'johnny']
+		assert names('jo', limit=1) == ['john']
+		assert names('suzan') == ['susan']
+		assert names('xyz') == []
+
+		# renames and new users show up without reloading
+		mary = User.query.filter_by(nickname='mary').first()
+		mary.nickname = 'joanna'
+		db.session.add(User(nickname='maryanne', email='maryanne@example.com'))
+		db.session.commit()
+		with QueryCounter() as queries:
+			assert names('joa')[0] == 'joanna'
+			assert names('mary') == ['maryanne']
+		assert queries.count == 0
+
+		# fuzzy scores compare trigram sets, not nickname lengths
+		db.session.add(User(nickname='aaaaaaaa', email='a@example.com'))
+		db.session.add(User(nickname='aaaz', email='z@example.com'))
+		db.session.commit()
+		assert [nickname_index.nicknames[id] for id in nickname_index.fuzzy('aaa', 2)] == ['aaaaaaaa', 'aaaz']
+
+		# while one thread reloads, the others answer from the old index
+		nickname_index.loaded_at -= app.config['TYPEAHEAD_REFRESH'] + 1
+		with nickname_index.reloading:
+			with QueryCounter() as queries:
+				assert names('joa')[0] == 'joanna'
+			assert queries.count == 0
+		with QueryCounter() as queries:
+			assert names('joa')[0] == 'joanna'
+		assert queries.count == 1
+
+		self.login(mary)
+		rv = self.app.get('/typeahead?q=johnn')
+		assert json.loads(rv.data.decode('utf-8'))['results'][0]['nickname'] == 'johnny'
+
+	def test_mail_dispatcher(self):
+		server = StubSMTPServer()
+		mail.get()
+		state = app.extensions['mail']
+		app.extensions['mail'] = mail.init_mail({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': server.port})
+		try:
+			dispatcher = MailDispatcher(app, mail)
+			for i in range(6):
+				assert dispatcher.send(Message('hello %d' % i, sender='admin@example.com', recipients=['john@example.com'], body='hi'))
+			dispatcher.queue.join()
+			dispatcher.shutdown()
+			assert len(server.messages) == 6
+			assert dispatcher.stats['sent'] == 6
+			# connections are reused rather than opened per message
+			assert server.connections <= dispatcher.workers
+		finally:
+			app.extensions['mail'] = state
+			server.stop()
+
+	def test_mail_dispatcher_full(self):
+		config = dict(app.config)
+		app.config.update(MAIL_WORKERS=0, MAIL_QUEUE_SIZE=1, MAIL_QUEUE_TIMEOUT=0)
+		try:
+			dispatcher = MailDispatcher(app, mail)
+		finally:
+			app.config.update(config)
+		msg = Message('hello', sender='admin@example.com', recipients=['john@example.com'], body='hi')
+		assert dispatcher.send(msg)
+		assert not dispatcher.send(msg)
+		assert dispatcher.stats['queued'] == 1
+		assert dispatcher.stats['dropped'] == 1
+
+	def test_mail_dispatcher_shutdown(self):
+		config = dict(app.config)
+		app.config.update(MAIL_WORKERS=1, MAIL_QUEUE_SIZE=1)
+		try:
+			dispatcher = MailDispatcher(app, mail)
+		finally:
+			app.config.update(config)
+		# a worker stuck on an unresponsive SMTP server
+		unblock = threading.Event()
+		class Connection(object):
+			def __enter__(self):
+				return self
+			def __exit__(self, *args):
+				pass
+			def send(self, msg):
+				unblock.wait()
+		dispatcher.mail = type('Mail', (object,), {'connect': lambda self: Connection()})()
+		msg = Message('hello', sender='admin@example.com', recipients=['john@example.com'], body='hi')
+		assert dispatcher.send(msg)
+		while not dispatcher.queue.empty():
+			unblock.wait(0.01)
+		assert dispatcher.send(msg)
+		try:
+			start = datetime.utcnow()
+			dispatcher.shutdown(timeout=0.2)
+			assert datetime.utcnow() - start < timedelta(seconds=1)
+			assert dispatcher.stats['dropped'] == 1
+		finally:
+			unblock.set()
+
+	def test_follower_digest(self):
+		susan = User(nickname='susan', email='susan@example.com', notify_digest=True)
+		followers = [User(nickname=nickname, email=nickname + '@example.com') for nickname in ['john', 'mary']]
+		db.session.add_all([susan] + followers)
+		db.session.commit()
+		queued = mailer.stats['queued']
+		for id in [follower.id for follower in followers]:
+			self.login(User.query.get(id))
+			self.app.get('/follow/susan')
+		assert FollowerNotification.query.count() == 2
+		assert mailer.stats['queued'] == queued
+
+		mail.get()
+		state = app.extensions['mail']
+		app.extensions['mail'] = mail.init_mail({'MAIL_SUPPRESS_SEND': True})
+		try:
+			with app.test_request_context():
+				with mail.record_messages() as outbox:
+					assert send_digests() == 1
+					assert send_digests() == 0
+		finally:
+			app.extensions['mail'] = state
+		assert len(outbox) == 1
+		assert outbox[0].recipients == ['susan@example.com']
+		assert 'john' in outbox[0].body and 'mary' in outbox[0].body
+		assert FollowerNotification.query.count() == 0
+
+	def test_fragment_cache(self):
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		utcnow = datetime.utcnow()
+		posts = [Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i)) for i in range(3)]
+		db.session.add_all(posts)
+		db.session.commit()
+		hits, misses = fragments.stats['hits'], fragments.stats['misses']
+		with app.test_request_context():
+			html = fragments.render_post(posts[0])
+			assert 'post 0' in html and 'john' in html
+			assert fragments.render_post(posts[0]) is html
+			assert (fragments.stats['hits'] - hits, fragments.stats['misses'] - misses) == (1, 1)
+
+			# edits and renames are not served stale
+			posts[0].body = 'edited post'
+			db.session.commit()
+			assert 'edited post' in fragments.render_post(posts[0])
+			fragments.render_post(posts[1])
+			u.nickname = 'johnny'
+			db.session.commit()
+			assert 'johnny' in fragments.render_post(posts[0])
+			assert 'johnny' in fragments.render_post(posts[1])
+
+			# as are renames committed by another process
+			db.session.execute(User.__table__.update().where(User.id == u.id).values(nickname='jon'))
+			db.session.commit()
+			assert 'jon said' in fragments.render_post(posts[0])
+
+			# the cache is bounded
+			size = fragments.size
+			fragments.size = 2
+			try:
+				for post in posts:
+					fragments.render_post(post)
+				assert len(fragments.fragments) == 2
+				assert posts[0].id not in fragments.by_post
+			finally:
+				fragments.size = size
+
+	def test_momentjs(self):
+		timestamp = datetime.utcnow() - timedelta(hours=2)
+		with app.test_request_context():
+			g.locale = 'es'
+			html = momentjs(timestamp).fromNow()
+			assert html.startswith('<time class="moment-from-now" datetime="%s">' % timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'))
+			assert 'hace 2 horas' in html
+			assert '<script>' not in momentjs(timestamp).calendar()
+			assert '<script>' not in momentjs(timestamp).format('LL')
+			app.config['MOMENTJS_MODE'] = 'client'
+			try:
+				assert 'moment("%s").fromNow()' % timestamp.strftime('%Y-%m-%dT%H:%M:%S Z') in momentjs(timestamp).fromNow()
+			finally:
+				app.config['MOMENTJS_MODE'] = 'server'
+
+	def test_conditional_get(self):
+		u = User(nickname='john', email='john@example.com')
+		u2 = User(nickname='susan', email='susan@example.com')
+		db.session.add_all([u, u2])
+		db.session.commit()
+		u.follow(u)
+		u.follow(u2)
+		db.session.commit()
+		db.session.add(Post(body='first post', author=u2, timestamp=datetime.utcnow()))
+		db.session.commit()
+		id, id2 = u.id, u2.id
+		self.login(u)
+		# streamed pages keep their request open until they are read
+
+		for url in ['/index', '/user/susan']:
+			rv = self.app.get(url, buffered=True)
+			assert rv.status_code == 200
+			etag = rv.headers['ETag']
+			assert etag.startswith('W/')
+			assert rv.headers['Cache-Control'] == app.config['PAGE_CACHE_CONTROL']
+			with QueryCounter() as queries:
+				rv = self.app.get(url, buffered=True, headers={'If-None-Match': etag})
+			assert rv.status_code == 304 and rv.data == b''
+			assert queries.count <= 3
+
+			# a heart changes the page
+			post = Post.query.filter_by(body='first post').first()
+			heart = UserPostHearts(user_id=id, post_id=post.id, timestamp=datetime.utcnow())
+			db.session.add(heart)
+			db.session.commit()
+			rv = self.app.get(url, buffered=True, headers={'If-None-Match': etag})
+			assert rv.status_code == 200 and rv.headers['ETag'] != etag
+			db.session.delete(heart)
+			db.session.commit()
+
+		# so does the viewer's own heart when the count stays the same
+		hearts = UserPostHearts.__table__
+		db.engine.execute(hearts.insert().values(user_id=id2, post_id=post.id))
+		etag = self.app.get('/index', buffered=True).headers['ETag']
+		db.engine.execute(hearts.delete().where(hearts.c.user_id == id2))
+		db.engine.execute(hearts.insert().values(user_id=id, post_id=post.id))
+		rv = self.app.get('/index', buffered=True, headers={'If-None-Match': etag})
+		assert rv.status_code == 200 and '/unheart_post/%d' % post.id in rv.data.decode()
+		db.engine.execute(hearts.delete())
+
+		# so do new posts and follows
+		etag = self.app.get('/index', buffered=True).headers['ETag']
+		db.session.add(Post(body='second post', author=User.query.get(id2), timestamp=datetime.utcnow()))
+		db.session.commit()
+		rv = self.app.get('/index', buffered=True, headers={'If-None-Match': etag})
+		assert rv.status_code == 200 and 'second post' in rv.data.decode()
+		etag = rv.headers['ETag']
+		User.query.get(id).unfollow(User.query.get(id2))
+		db.session.commit()
+		assert self.app.get('/index', buffered=True, headers={'If-None-Match': etag}).status_code == 200
+
+		# activity the pages do not show leaves them cached
+		etag = self.app.get('/index', buffered=True).headers['ETag']
+		u3, u4 = User(nickname='mary', email='mary@example.com'), User(nickname='david', email='david@example.com')
+		db.session.add_all([u3, u4])
+		db.session.commit()
+		hidden = Post(body='hidden post', author=u3, timestamp=datetime.utcnow())
+		db.session.add(hidden)
+		db.session.add(u3.follow(u4))
+		db.session.commit()
+		db.session.add(UserPostHearts(user_id=u4.id, post_id=hidden.id, timestamp=datetime.utcnow()))
+		db.session.commit()
+		assert self.app.get('/index', buffered=True, headers={'If-None-Match': etag}).status_code == 304
+
+		# a new session has a new CSRF token for its forms
+		with self.app.session_transaction() as session:
+			session['csrf_token'] = 'another token'
+		assert self.app.get('/index', buffered=True, headers={'If-None-Match': etag}).status_code == 200
+
+	def test_assets(self):
+		with app.test_request_context():
+			url = assets.static_url('js/site.js')
+			css = assets.static_url('css/bootstrap.min.css')
+			assert assets.static_url('js/missing.js') == '/static/js/missing.js'
+		assert re.match(r'^/assets/js/site\.[0-9a-f]{12}\.js$', url)
+		rv = self.app.get(url)
+		assert rv.status_code == 200
+		assert 'immutable' in rv.headers['Cache-Control']
+		assert 'Content-Encoding' not in rv.headers
+		assert b'jQuery' in rv.data and b'sourceMappingURL' not in rv.data
+		rv = self.app.get(css, headers={'Accept-Encoding': 'gzip'})
+		assert rv.headers['Content-Encoding'] == 'gzip'
+		with open(os.path.join(app.static_folder, 'css/bootstrap.min.css'), 'rb') as f:
+			assert gzip.decompress(rv.data) == f.read()
+		assert self.app.get(css, headers={'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']}).status_code == 304
+		assert self.app.get('/assets/js/site.000000000000.js').status_code == 404
+
+		# the bundled moment.js follows MOMENTJS_MODE as the app is configured
+		assert assets.sources[assets.manifest['js/site.js']][-1] == 'js/moment-lite.js'
+		app.config['MOMENTJS_MODE'] = 'client'
+		try:
+			assets.build()
+			assert assets.sources[assets.manifest['js/site.js']][-1] == 'js/moment.min.js'
+			# pages name the locale's moment.js only when there is one
+			for language in [None, 'fr']:
+				rv = self.app.get('/login', headers={'Accept-Language': language} if language else {})
+				assert rv.status_code == 200 and b'moment-' not in rv.data
+			assert b'moment-es' in self.app.get('/login', headers={'Accept-Language': 'es'}).data
+		finally:
+			app.config['MOMENTJS_MODE'] = 'server'
+			assets.build()
+
+	def test_streaming_and_compression(self):
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		db.session.commit()
+		u.follow(u)
+		db.session.add(Post(body='streamed post', author=u, timestamp=datetime.utcnow()))
+		db.session.commit()
+		self.login(u)
+		rv = self.app.get('/index', headers={'Accept-Encoding': 'gzip'})
+		assert rv.is_streamed
+		assert rv.headers['Content-Encoding'] == 'gzip' and 'Content-Length' not in rv.headers
+		assert 'streamed post' in gzip.decompress(rv.data).decode('utf-8')
+		assert 'Content-Encoding' not in self.app.get('/index', buffered=True).headers
+		# a flash shows on the next streamed page only
+		rv = self.app.post('/index', data={'post': 'flashed post'})
+		assert rv.status_code == 302
+		rv = self.app.get('/index')
+		assert rv.is_streamed and 'Your post is now live!' in rv.data.decode('utf-8')
+		rv = self.app.get('/index')
+		assert rv.is_streamed and 'Your post is now live!' not in rv.data.decode('utf-8')
+		# small responses are not worth compressing
+		rv = self.app.get('/typeahead?q=zz', headers={'Accept-Encoding': 'gzip'})
+		assert 'Content-Encoding' not in rv.headers and json.loads(rv.data.decode('utf-8')) == {'results': []}
+
+	def test_lazy_extension(self):
+		ext = LazyExtension('collections', 'Counter', 'abca')
+		loaded = []
+		ext.on_load(loaded.append)
+		assert not ext.loaded and loaded == []
+		assert ext.most_common(1) == [('a', 2)]
+		assert ext.loaded and loaded == [ext.extension]
+		# the login page pulls in OpenID on demand
+		rv = self.app.get('/login')
+		assert rv.status_code == 200 and b'openid' in rv.data
+
+	def test_sqlite_pragmas(self):
+		from sqlalchemy.pool import QueuePool
+		assert isinstance(db.engine.pool, QueuePool)
+		connection = db.engine.connect()
+		try:
+			assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+			assert connection.execute('PRAGMA synchronous').scalar() == 1	# NORMAL
+			assert connection.execute('PRAGMA busy_timeout').scalar() == 5000
+		finally:
+			connection.close()
+
+	def test_query_plans(self):
+		u = User(nickname='john', email='john@example.com')
+		p = Post(body='post', author=u, timestamp=datetime.utcnow())
+		db.session.add_all([u, p])
+		db.session.commit()
+		hot = [(u.followed.filter(followers.c.followed_id == u.id), 'ix_followers_follower_followed'),
+			   (db.session.query(followers.c.follower_id).filter(followers.c.followed_id == u.id), 'ix_followers_followed_follower'),
+			   (db.session.query(UserPostHearts.post_id).filter_by(post_id=p.id, user_id=u.id), 'sqlite_autoindex_user_post_hearts'),
+			   (db.session.query(UserPostHearts.post_id).filter_by(user_id=u.id).filter(UserPostHearts.post_id.in_([p.id])), 'sqlite_autoindex_user_post_hearts'),
+			   (u.post_hearts, 'ix_user_post_hearts_user_post'),
+			   (u.profile_posts(), 'ix_post_user_timestamp'),
+			   (u.followed_posts(), 'ix_post_user_timestamp')]
+		for query, index in hot:
+			plan = query_plan(query)
+			# every table is searched through an index, none is scanned
+			assert all(step.startswith('SEARCH') or step.startswith('USE TEMP B-TREE') for step in plan), plan
+			assert any(index in step for step in plan), plan
+		# the index is in (timestamp, id) order, so the profile pages need no sort
+		cursor = encode_cursor(p.timestamp, p.id)
+		for before, after in [(None, None), (cursor, None), (None, cursor)]:
+			plans = executed_plans(lambda: u.profile_posts().paginate_keyset(before, after, 5))
+			assert plans and all(any('ix_post_user_timestamp' in step for step in plan) for plan in plans), plans
+			assert not any('TEMP B-TREE' in step for plan in plans for step in plan), plans
+
+	def test_index_query_count(self):
+		u = User(nickname='john', email='john@example.com')
+		db.session.add(u)
+		db.session.commit()
+		u.follow(u)
+		db.session.commit()
+		self.login(u)
+
+		def render_index():
+			with QueryCounter() as queries:
+				rv = self.app.get('/index', buffered=True)
+			assert rv.status_code == 200
+			return queries.count
+
+		utcnow = datetime.utcnow()
+		db.session.add(Post(body='first post', author=u, timestamp=utcnow))
+		db.session.commit()
+		one_post = render_index()
+		db.session.add_all([Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i + 1)) for i in range(10)])
+		db.session.commit()
+		db.session.add_all([UserPostHearts(user_id=u.id, post_id=p.id) for p in Post.query.all()])
+		db.session.commit()
+		full_page = render_index()
+		assert one_post == full_page
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file